@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+from flask import Flask, Response, jsonify, request
+from omegaconf import OmegaConf
+
+MODEL_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model"
+)
+sys.path.append(MODEL_DIR)
+
+from image_codec import FORMAT_LIST, SUPPORTED_FORMATS, encode_image  # noqa: E402
+
+app = Flask(__name__)
+ARGS = None
+OPT = None
+
+# the model generates one batch at a time, like a single gpu
+GPU_LOCK = threading.Lock()
+STATS = {"requests": 0, "items": 0, "images": 0, "busy_seconds": 0.0}
+STATS_LOCK = threading.Lock()
+
+# the first stage of SD v1 decodes H // f by W // f latents 8 times larger
+DECODER_FACTOR = 8
+
+
+def item_params(tier):
+    # the same tiers and defaults as model_service.tier_params
+    params = {key: OPT[key] for key in ("H", "W", "n_samples")}
+    if tier in OPT.tiers:
+        params.update({key: OPT.tiers[tier][key] for key in params})
+    return params
+
+
+def make_image(params):
+    # a smooth image with some noise, so PNG sizes are close to real ones
+    h = params["H"] // OPT.f * DECODER_FACTOR
+    w = params["W"] // OPT.f * DECODER_FACTOR
+    low = np.random.randint(0, 255, (h // 32 + 1, w // 32 + 1, 3), dtype=np.uint8)
+    img = low.repeat(32, axis=0).repeat(32, axis=1)[:h, :w]
+    noise = np.random.randint(-8, 8, img.shape)
+    return np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def parse_request(content):
+    image_format = content.get("format", FORMAT_LIST)
+    if image_format not in SUPPORTED_FORMATS:
+        image_format = FORMAT_LIST
+
+    items = [(item["id"], item_params(item.get("tier"))) for item in content["data"]]
+    return items, image_format
+
+
+def generate_results(items, image_format):
+    # items are sampled in batches of max_batch, every image takes image_latency
+    for ind in range(0, len(items), OPT.max_batch):
+        batch = items[ind : ind + OPT.max_batch]
+        n_images = sum(params["n_samples"] for _, params in batch)
+
+        with GPU_LOCK:
+            start = time.time()
+            time.sleep(ARGS.image_latency * n_images)
+            images = [
+                [make_image(params) for _ in range(params["n_samples"])]
+                for _, params in batch
+            ]
+            busy = time.time() - start
+
+        with STATS_LOCK:
+            STATS["items"] += len(batch)
+            STATS["images"] += n_images
+            STATS["busy_seconds"] += busy
+
+        for (user_id, _), imgs in zip(batch, images):
+            yield {
+                "id": user_id,
+                "images": {
+                    str(ind): encode_image(img, image_format)
+                    for ind, img in enumerate(imgs)
+                },
+            }
+
+
+@app.route("/v1/models/<name>", methods=["GET"])
+def model_status(name):
+    return jsonify({"name": name, "ready": True})
+
+
+@app.route("/v1/models/<name>:predict", methods=["POST"])
+def predict(name):
+    with STATS_LOCK:
+        STATS["requests"] += 1
+
+    items, image_format = parse_request(request.json)
+    output = list(generate_results(items, image_format))
+    return jsonify({"data": output, "result": len(output), "format": image_format})
+
+
+@app.route("/v1/models/<name>:predict_stream", methods=["POST"])
+def predict_stream(name):
+    with STATS_LOCK:
+        STATS["requests"] += 1
+
+    items, image_format = parse_request(request.json)
+
+    def generate():
+        for item in generate_results(items, image_format):
+            yield json.dumps(item) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    with STATS_LOCK:
+        return jsonify(STATS)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Model stub with the real payload format and a fixed latency"
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--image-latency", type=float, default=0.5)
+    parser.add_argument("--config", default=os.path.join(MODEL_DIR, "config.yaml"))
+
+    global ARGS, OPT
+    ARGS = parser.parse_args()
+    OPT = OmegaConf.load(ARGS.config)
+
+    app.run(port=ARGS.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import json
+import time
+import random
+import argparse
+import threading
+
+import numpy as np
+import requests
+
+# request states, see website/db.py
+STAT_QUEUED = 1
+STAT_RUNNING = 2
+FINAL_STATS = {3: "done", 4: "error", 5: "expired"}
+
+PERCENTILES = (50, 90, 99)
+
+
+class LoadGenerator:
+    # browser sessions: each one submits a prompt through get_results, polls
+    # /api/v1/ready until it's finished, opens the results and thinks a bit
+    def __init__(
+        self,
+        url,
+        sessions,
+        prompts_per_session,
+        unique_prompts=1.0,
+        shared_prompts=5,
+        poll_interval=0.5,
+        think_time=1.0,
+        timeout=300,
+    ):
+        self.url = url.rstrip("/")
+        self.sessions = sessions
+        self.prompts_per_session = prompts_per_session
+        self.unique_prompts = unique_prompts
+        self.shared_prompts = shared_prompts
+        self.poll_interval = poll_interval
+        self.think_time = think_time
+        self.timeout = timeout
+
+        # prompts of different runs never meet in the result cache
+        self.run_id = "%06x" % random.randrange(16**6)
+        self.lock = threading.Lock()
+        self.records = []
+        self.requests = 0
+        self.request_errors = 0
+        self.prompt_counter = 0
+
+    def next_prompt(self):
+        # the rest repeat a few popular prompts, those are coalesced or cached
+        with self.lock:
+            if random.random() < self.unique_prompts:
+                self.prompt_counter += 1
+                return f"bench {self.run_id} prompt {self.prompt_counter}"
+        return f"bench {self.run_id} shared {random.randrange(self.shared_prompts)}"
+
+    def count_response(self, response, *args, **kwargs):
+        with self.lock:
+            self.requests += 1
+
+    def get(self, session, path, **kwargs):
+        try:
+            return session.get(self.url + path, timeout=30, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.request_errors += 1
+            return None
+
+    def submit(self, session, prompt, deadline):
+        # a rejected submission is retried after Retry-After, like the page does
+        rejected = 0
+        while time.time() < deadline:
+            response = self.get(session, "/get_results", params={"text": prompt})
+            if response is not None and response.status_code != 429:
+                return response.ok, rejected
+
+            rejected += 1
+            retry_after = 1.0
+            if response is not None:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            time.sleep(min(retry_after, max(deadline - time.time(), 0)))
+
+        return False, rejected
+
+    def wait_ready(self, session, deadline):
+        while time.time() < deadline:
+            response = self.get(session, "/api/v1/ready")
+            if response is not None and response.ok:
+                status = response.json()["status"]
+                if status in FINAL_STATS:
+                    return FINAL_STATS[status]
+            time.sleep(self.poll_interval)
+        return "timeout"
+
+    def run_session(self):
+        session = requests.Session()
+        session.hooks["response"].append(self.count_response)
+
+        for _ in range(self.prompts_per_session):
+            prompt = self.next_prompt()
+            start = time.time()
+            deadline = start + self.timeout
+
+            submitted, rejected = self.submit(session, prompt, deadline)
+            status = self.wait_ready(session, deadline) if submitted else "rejected"
+            ready = time.time()
+
+            if status == "done":
+                self.get(session, "/get_results")
+
+            with self.lock:
+                self.records.append(
+                    {
+                        "prompt": prompt,
+                        "status": status,
+                        "rejected": rejected,
+                        "latency": ready - start,
+                    }
+                )
+
+            time.sleep(random.uniform(0, 2 * self.think_time))
+
+    def run(self):
+        start = time.time()
+        threads = [
+            threading.Thread(target=self.run_session) for _ in range(self.sessions)
+        ]
+        for thread in threads:
+            thread.start()
+            # sessions don't all arrive in the same millisecond
+            time.sleep(random.uniform(0, self.poll_interval))
+        for thread in threads:
+            thread.join()
+
+        return self.summary(time.time() - start)
+
+    def summary(self, duration):
+        latencies = [
+            record["latency"] for record in self.records if record["status"] == "done"
+        ]
+        statuses = {}
+        for record in self.records:
+            statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+
+        latency = {"mean": None, "max": None}
+        latency.update({f"p{p}": None for p in PERCENTILES})
+        if latencies:
+            latency["mean"] = float(np.mean(latencies))
+            latency["max"] = float(np.max(latencies))
+            for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+                latency[f"p{p}"] = float(value)
+
+        return {
+            "duration_seconds": duration,
+            "submissions": len(self.records),
+            "statuses": statuses,
+            "rejected_attempts": sum(record["rejected"] for record in self.records),
+            "submit_to_ready_seconds": latency,
+            "coordinator": {
+                "requests": self.requests,
+                "request_errors": self.request_errors,
+                "requests_per_second": self.requests / duration,
+                "completed_per_second": len(latencies) / duration,
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Browser sessions submitting prompts to a running website"
+    )
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--prompts-per-session", type=int, default=3)
+    parser.add_argument("--unique-prompts", type=float, default=1.0)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--think-time", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    generator = LoadGenerator(
+        args.url,
+        args.sessions,
+        args.prompts_per_session,
+        unique_prompts=args.unique_prompts,
+        poll_interval=args.poll_interval,
+        think_time=args.think_time,
+        timeout=args.timeout,
+    )
+    print(json.dumps(generator.run(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
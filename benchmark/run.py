@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime as dt
+
+import requests
+from omegaconf import OmegaConf
+
+from load_generator import LoadGenerator
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+WEBSITE_DIR = os.path.join(ROOT_DIR, "website")
+WORKER_DIR = os.path.join(ROOT_DIR, "worker")
+
+STARTUP_TIMEOUT_SECONDS = 30
+SHUTDOWN_TIMEOUT_SECONDS = 30
+
+# metrics compared with a baseline report, True when higher is better
+COMPARED_METRICS = {
+    "submit_to_ready_seconds.p50": False,
+    "submit_to_ready_seconds.p90": False,
+    "submit_to_ready_seconds.p99": False,
+    "coordinator.completed_per_second": True,
+    "worker_utilisation": True,
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, process):
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} didn't start in {STARTUP_TIMEOUT_SECONDS} s")
+
+
+class Processes:
+    # the services of one scenario, their output goes to files in the run dir
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.processes = []
+
+    def start(self, name, args, cwd):
+        log = open(os.path.join(self.run_dir, f"{name}.log"), "wb")
+        process = subprocess.Popen(
+            [sys.executable, *args], cwd=cwd, stdout=log, stderr=subprocess.STDOUT
+        )
+        self.processes.append((process, log))
+        return process
+
+    def stop(self):
+        # the worker finishes its claimed tasks on SIGTERM
+        for process, _ in self.processes:
+            process.terminate()
+        for process, log in self.processes:
+            try:
+                process.wait(timeout=SHUTDOWN_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+
+
+def start_website(processes, run_dir):
+    website_dir = os.path.join(run_dir, "website")
+    os.makedirs(os.path.join(website_dir, "database"))
+    with open(os.path.join(WEBSITE_DIR, "database", "schema.sql")) as fp:
+        connection = sqlite3.connect(
+            os.path.join(website_dir, "database", "database.db")
+        )
+        connection.executescript(fp.read())
+        connection.close()
+
+    port = free_port()
+    process = processes.start(
+        "website",
+        [
+            "-m",
+            "flask",
+            "--app",
+            os.path.join(WEBSITE_DIR, "server.py"),
+            "run",
+            "--port",
+            str(port),
+        ],
+        website_dir,
+    )
+    url = f"http://127.0.0.1:{port}"
+    wait_for(url + "/", process)
+    return url
+
+
+def start_models(processes, scenario):
+    urls = []
+    for ind in range(scenario.replicas):
+        port = free_port()
+        process = processes.start(
+            f"model_{ind}",
+            [
+                os.path.join(BENCHMARK_DIR, "fake_model.py"),
+                "--port",
+                str(port),
+                "--image-latency",
+                str(scenario.image_latency),
+            ],
+            BENCHMARK_DIR,
+        )
+        url = f"http://127.0.0.1:{port}"
+        wait_for(url + "/stats", process)
+        urls.append(url)
+    return urls
+
+
+def start_worker(processes, run_dir, scenario, website_url, model_urls):
+    worker_dir = os.path.join(run_dir, "worker")
+    os.makedirs(os.path.join(worker_dir, "logs"))
+
+    conf = OmegaConf.load(os.path.join(WORKER_DIR, "worker_config.yaml"))
+    conf.model_access.replicas = model_urls
+    conf.coordinator_access.token = "mytoken"
+    conf.coordinator_access.url_get = f"{website_url}/api/v1/get_task"
+    conf.coordinator_access.url_send = f"{website_url}/api/v1/send_task"
+    conf.coordinator_access.url_preview = f"{website_url}/api/v1/preview"
+    conf.previews.enabled = False
+    conf.metrics.port = free_port()
+    conf = OmegaConf.merge(conf, scenario.worker)
+    OmegaConf.save(conf, os.path.join(worker_dir, "worker_config.yaml"))
+
+    processes.start("worker", [os.path.join(WORKER_DIR, "worker.py")], worker_dir)
+
+
+def model_stats(model_urls):
+    return [requests.get(url + "/stats", timeout=5).json() for url in model_urls]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(name, scenario, keep):
+    started = dt.now().isoformat(timespec="seconds")
+    run_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    processes = Processes(run_dir)
+    try:
+        website_url = start_website(processes, run_dir)
+        model_urls = start_models(processes, scenario)
+        start_worker(processes, run_dir, scenario, website_url, model_urls)
+
+        before = model_stats(model_urls)
+        generator = LoadGenerator(
+            website_url,
+            scenario.sessions,
+            scenario.prompts_per_session,
+            unique_prompts=scenario.unique_prompts,
+            shared_prompts=scenario.shared_prompts,
+            poll_interval=scenario.poll_interval,
+            think_time=scenario.think_time,
+            timeout=scenario.timeout,
+        )
+        result = generator.run()
+        after = model_stats(model_urls)
+    finally:
+        processes.stop()
+
+    # the share of time the worker kept the model replicas busy
+    duration = result["duration_seconds"]
+    busy = [b["busy_seconds"] - a["busy_seconds"] for a, b in zip(before, after)]
+    result["worker_utilisation"] = sum(busy) / (duration * len(busy))
+    result["model"] = {
+        key: sum(b[key] - a[key] for a, b in zip(before, after))
+        for key in ("requests", "items", "images")
+    }
+
+    if keep:
+        print(f"Logs of {name} are kept in {run_dir}")
+    else:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return {
+        "scenario": name,
+        "settings": OmegaConf.to_container(scenario),
+        "commit": git_commit(),
+        "started": started,
+        **result,
+    }
+
+
+def get_metric(report, path):
+    value = report
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(report, baseline, tolerance):
+    # a metric is a regression when it's worse than the baseline by tolerance
+    regressions = []
+    for path, higher_is_better in COMPARED_METRICS.items():
+        new, old = get_metric(report, path), get_metric(baseline, path)
+        if new is None or not old:
+            continue
+
+        change = new / old - 1
+        worse = -change if higher_is_better else change
+        mark = "REGRESSION" if worse > tolerance else ""
+        print(f"  {path:36} {old:10.3f} -> {new:10.3f} {change:+7.1%} {mark}")
+        if mark:
+            regressions.append(path)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Website, worker and fake model under simulated browser load"
+    )
+    parser.add_argument("scenarios", nargs="*", default=["smoke"])
+    parser.add_argument(
+        "--config", default=os.path.join(BENCHMARK_DIR, "scenarios.yaml")
+    )
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "reports"))
+    parser.add_argument("--baseline", default=None, help="report dir to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep", action="store_true", help="keep logs and data")
+    args = parser.parse_args()
+
+    conf = OmegaConf.load(args.config)
+    names = list(conf.scenarios) if args.scenarios == ["all"] else args.scenarios
+    os.makedirs(args.output, exist_ok=True)
+
+    # baselines are read before anything is written, the dirs may be the same
+    baselines = {}
+    for name in names:
+        path = args.baseline and os.path.join(args.baseline, f"{name}.json")
+        if path and os.path.exists(path):
+            with open(path) as fp:
+                baselines[name] = json.load(fp)
+
+    regressions = []
+    for name in names:
+        scenario = OmegaConf.merge(conf.defaults, conf.scenarios[name])
+        print(f"Running {name}")
+        report = run_scenario(name, scenario, args.keep)
+
+        path = os.path.join(args.output, f"{name}.json")
+        with open(path, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+        print(
+            f"{name}: {report['statuses']}, "
+            f"latency {report['submit_to_ready_seconds']}, "
+            f"{report['coordinator']['requests_per_second']:.1f} req/s, "
+            f"utilisation {report['worker_utilisation']:.0%}, saved to {path}"
+        )
+
+        if name in baselines:
+            for metric in compare(report, baselines[name], args.tolerance):
+                regressions.append(f"{name}: {metric}")
+
+    if regressions:
+        print("Regressions:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
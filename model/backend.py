@@ -0,0 +1,114 @@
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+DEVICES = ("cuda", "cpu")
+# cpu features that make bf16 matmuls faster than fp32 ones
+BF16_CPU_FLAGS = ("avx512_bf16", "amx_bf16")
+
+
+def cpu_flags():
+    try:
+        with open("/proc/cpuinfo") as fp:
+            for line in fp:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def cpu_supports_bf16():
+    return any(flag in cpu_flags() for flag in BF16_CPU_FLAGS)
+
+
+class DeviceBackend:
+    # where the model runs and how: dtype of the weights, autocast, threads
+    def __init__(self, opt, logger=None):
+        self.device = opt.device
+        if self.device not in DEVICES:
+            raise ValueError(f"Unknown device '{self.device}', expected {DEVICES}")
+
+        self.logger = logger
+        self.autocast = opt.precision == "autocast"
+        self.channels_last = False
+        self.bf16 = False
+
+        if self.device == "cpu":
+            self.channels_last = opt.cpu.channels_last
+            # without native bf16 autocast is slower than plain fp32 on cpu
+            self.bf16 = self.autocast and opt.cpu.bf16 and cpu_supports_bf16()
+
+            if opt.cpu.threads:
+                torch.set_num_threads(opt.cpu.threads)
+            if opt.cpu.interop_threads:
+                torch.set_num_interop_threads(opt.cpu.interop_threads)
+
+        self.log(
+            f"Device {self.device}: autocast {self.autocast}, bf16 {self.bf16}, "
+            f"channels_last {self.channels_last}, threads {torch.get_num_threads()}"
+        )
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+    @property
+    def dtype(self):
+        # half precision weights only on gpu, cpu kernels for fp16 are slow or
+        # missing, there the weights stay fp32 and bf16 comes from autocast
+        return torch.float16 if self.device == "cuda" else torch.float32
+
+    @contextmanager
+    def init_scope(self):
+        # modules created here have the final dtype, and are created on the
+        # device when torch supports it as a context manager
+        default_dtype = torch.get_default_dtype()
+        torch.set_default_dtype(self.dtype)
+        try:
+            if hasattr(torch.device, "__enter__"):
+                with torch.device(self.device):
+                    yield
+            else:
+                yield
+        finally:
+            torch.set_default_dtype(default_dtype)
+
+    def prepare(self, model):
+        model = model.to(device=self.device, dtype=self.dtype)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+
+        # the text encoder moves its tokens to its own device, cuda by default
+        cond_stage_model = getattr(model, "cond_stage_model", None)
+        if cond_stage_model is not None and hasattr(cond_stage_model, "device"):
+            cond_stage_model.device = self.device
+
+        return model.eval()
+
+    def prepare_sampler(self, sampler):
+        # the samplers keep their schedule on cuda whatever the model device is
+        def register_buffer(name, attr):
+            if isinstance(attr, torch.Tensor):
+                attr = attr.to(self.device)
+            setattr(sampler, name, attr)
+
+        sampler.register_buffer = register_buffer
+        return sampler
+
+    def precision_scope(self):
+        if not self.autocast:
+            return nullcontext()
+        if self.device == "cuda":
+            return torch.autocast("cuda")
+        if self.bf16:
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return nullcontext()
+
+    def inference_scope(self):
+        return torch.inference_mode()
+
+    def synchronize(self):
+        # cuda kernels run asynchronously, timings wait for them
+        if self.device == "cuda":
+            torch.cuda.synchronize()
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+import torch
+
+
+class ConditioningCache:
+    def __init__(self, model, max_size: int):
+        self.model = model
+        self.max_size = max_size
+
+        self.embeddings = OrderedDict()
+        self.unconditional = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        with torch.no_grad():
+            self.unconditional = self.model.get_learned_conditioning([""])
+
+    def encode(self, prompts):
+        missing = []
+        for prompt in dict.fromkeys(prompts):
+            if prompt in self.embeddings:
+                self.embeddings.move_to_end(prompt)
+                self.hits += 1
+            else:
+                missing.append(prompt)
+                self.misses += 1
+
+        if missing:
+            for prompt, embedding in zip(
+                missing, self.model.get_learned_conditioning(missing)
+            ):
+                self.embeddings[prompt] = embedding
+
+        embeddings = torch.stack([self.embeddings[prompt] for prompt in prompts])
+
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+        return embeddings
+
+    def conditioning(self, prompts, n_samples: int):
+        # each unique prompt is encoded once and shared by all of its samples
+        return self.encode(prompts).repeat_interleave(n_samples, dim=0)
+
+    def unconditional_conditioning(self, batch_size: int):
+        return self.unconditional.expand(batch_size, *self.unconditional.shape[1:])
+
+    def stats(self):
+        return {"size": len(self.embeddings), "hits": self.hits, "misses": self.misses}
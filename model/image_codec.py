@@ -0,0 +1,33 @@
+import io
+import base64
+
+import numpy as np
+from PIL import Image
+
+FORMAT_LIST = "list"
+FORMAT_RAW = "raw"
+FORMAT_PNG = "png"
+
+SUPPORTED_FORMATS = (FORMAT_PNG, FORMAT_RAW, FORMAT_LIST)
+
+
+def encode_image(img: np.ndarray, image_format: str = FORMAT_LIST):
+    # old format, kept for workers and coordinators which don't negotiate
+    if image_format == FORMAT_LIST:
+        return img.flatten().tolist()
+
+    if image_format == FORMAT_RAW:
+        data = np.ascontiguousarray(img).tobytes()
+    elif image_format == FORMAT_PNG:
+        buffer = io.BytesIO()
+        Image.fromarray(img).save(buffer, format="PNG")
+        data = buffer.getvalue()
+    else:
+        raise ValueError(f"Unknown image format '{image_format}'")
+
+    return {
+        "format": image_format,
+        "shape": list(img.shape),
+        "dtype": str(img.dtype),
+        "data": base64.b64encode(data).decode("ascii"),
+    }
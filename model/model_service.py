@@ -1,6 +1,9 @@
 import os
 import re
+import time
 import torch
+import threading
+import traceback
 import logging
 import kfserving
 import numpy as np
@@ -8,14 +11,35 @@ from omegaconf import OmegaConf
 from tqdm import tqdm, trange
 from itertools import islice
 from einops import rearrange
-from torch.cuda.amp import autocast
-from contextlib import nullcontext
 from logging.handlers import TimedRotatingFileHandler
 
 from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 
+from backend import DeviceBackend
+from conditioning import ConditioningCache
+from image_codec import FORMAT_LIST, SUPPORTED_FORMATS, encode_image
+from metrics import Counter, Histogram
+from previews import PreviewSender, make_img_callback
+from streaming import StreamingKFServer
+from weights import build_fp16_model, has_fp16_weights, peak_rss_mb
+
+# settings a quality tier may override
+TIER_KEYS = ("ddim_steps", "H", "W", "n_samples")
+
+ITEM_SECONDS = Histogram(
+    "model_item_seconds", "Generation time per item, its share of the batch", ["tier"]
+)
+STEP_SECONDS = Histogram(
+    "model_step_seconds", "Mean sampler step time of a batch", ["tier"]
+)
+ENCODE_SECONDS = Histogram(
+    "model_encode_seconds", "Encoding time of one image", ["format"]
+)
+ITEMS = Counter("model_items_total", "Generated items by result", ["result"])
+RETRIES = Counter("model_retries_total", "Failed batches retried item by item")
+
 
 class CustomFormatter(logging.Formatter):
     format_pattern = "[{level} %(asctime)s %(pathname)s:%(lineno)d] %(message)s"
@@ -54,12 +78,23 @@ class KFStableDiffusionModel(kfserving.KFModel):
         if self.opt.laion400m:
             self.opt.config = "configs/latent-diffusion/txt2img-1p4B-eval.yaml"
             self.opt.ckpt = "models/ldm/text2img-large/model.ckpt"
+            self.opt.fp16_weights = "models/ldm/text2img-large/model.fp16.safetensors"
 
         self.config = OmegaConf.load(f"{self.opt.config}")
 
+        self.device = self.opt.device
+        self.backend = None
         self.model = None
         self.logger = None
 
+        self.sampler = None
+        self.conditioning = None
+        self.start_codes = {}
+        self.previews = None
+
+        # streaming predictions run in a thread, the GPU is used by one at a time
+        self.lock = threading.Lock()
+
     def load(self):
         self.logger = logging.getLogger(__name__)
         log_handler = TimedRotatingFileHandler("logs/app.log", backupCount=24)
@@ -67,15 +102,95 @@ class KFStableDiffusionModel(kfserving.KFModel):
         log_handler.setFormatter(CustomFormatter())
         self.logger.addHandler(log_handler)
 
-        self.model = self.load_model_from_config(self.config, f"{self.opt.ckpt}")
-        self.model = self.model.half()
+        self.backend = DeviceBackend(self.opt, self.logger)
+
+        start = time.time()
+        if has_fp16_weights(self.opt.fp16_weights):
+            self.model = self.load_fp16_model(self.config, self.opt.fp16_weights)
+        else:
+            self.model = self.load_model_from_config(self.config, f"{self.opt.ckpt}")
+        self.logger.info(
+            f"Model loaded in {time.time() - start:.1f} s, "
+            f"peak RSS {peak_rss_mb():.0f} MB"
+        )
+
+        self.sampler = self.build_sampler()
+        self.conditioning = ConditioningCache(
+            self.model, self.opt.conditioning_cache_size
+        )
+        self.conditioning.load()
+        self.previews = PreviewSender(self.opt.preview_timeout, self.logger)
 
         self.ready = True
 
-    def predict(self, request):
+    def tier_params(self, tier=None):
+        # quality tiers override the step count, resolution and sample count
+        params = {key: self.opt[key] for key in TIER_KEYS}
+        if tier is not None:
+            params.update(self.opt.tiers[tier])
+        params["tier"] = tier or "default"
+        return params
+
+    def get_start_code(self, params):
+        # the same noise for every shape, so cached results stay reproducible
+        if not self.opt.fixed_code:
+            return None
+
+        key = (params["n_samples"], params["H"], params["W"])
+        if key not in self.start_codes:
+            generator = torch.Generator(device=self.device).manual_seed(self.opt.seed)
+            self.start_codes[key] = torch.randn(
+                [
+                    params["n_samples"],
+                    self.opt.C,
+                    params["H"] // self.opt.f,
+                    params["W"] // self.opt.f,
+                ],
+                generator=generator,
+                device=self.device,
+            )
+        return self.start_codes[key]
+
+    def build_sampler(self):
+        if self.opt.plms:
+            sampler = PLMSSampler(self.model)
+        else:
+            sampler = DDIMSampler(self.model)
+        sampler = self.backend.prepare_sampler(sampler)
+
+        # sample() rebuilds the schedule buffers on every call, keep them
+        # while the number of steps and eta stay the same
+        make_schedule = sampler.make_schedule
+        schedule = {}
+
+        def cached_make_schedule(
+            ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True
+        ):
+            key = (ddim_num_steps, ddim_discretize, ddim_eta)
+            if schedule.get("key") != key:
+                make_schedule(
+                    ddim_num_steps=ddim_num_steps,
+                    ddim_discretize=ddim_discretize,
+                    ddim_eta=ddim_eta,
+                    verbose=verbose,
+                )
+                schedule["key"] = key
+
+        sampler.make_schedule = cached_make_schedule
+        return sampler
+
+    def parse_request(self, request):
         data = request["data"]
 
-        output = []
+        image_format = request.get("format", FORMAT_LIST)
+        if image_format not in SUPPORTED_FORMATS:
+            self.logger.warning(f"Unknown image format '{image_format}', using list")
+            image_format = FORMAT_LIST
+
+        # the worker may ask for previews while the images are sampled
+        preview_url = request.get("preview_url") if self.opt.preview_every else None
+
+        items = []
 
         for item in data:
             try:
@@ -87,22 +202,90 @@ class KFStableDiffusionModel(kfserving.KFModel):
                 self.logger.error("Can't parse data")
                 continue
 
-            try:
-                images = self.generate(text)
-                output.append(
-                    {
+            tier = item.get("tier")
+            if tier is not None and tier not in self.opt.tiers:
+                self.logger.warning(f"Unknown quality tier '{tier}', using defaults")
+                tier = None
+
+            items.append((user_id, text, tier))
+
+        return items, image_format, preview_url
+
+    def predict(self, request):
+        items, image_format, preview_url = self.parse_request(request)
+        output = list(self.generate_results(items, image_format, preview_url))
+
+        return {"data": output, "result": len(output), "format": image_format}
+
+    def predict_stream(self, request):
+        # results of the items one by one, as soon as their batch is sampled
+        items, image_format, preview_url = self.parse_request(request)
+        return self.generate_results(items, image_format, preview_url)
+
+    def generate_results(self, items, image_format, preview_url=None):
+        # only items of the same tier can be sampled in one batch
+        tiers = {}
+        for user_id, text, tier in items:
+            tiers.setdefault(tier, []).append((user_id, text))
+
+        for tier, tier_items in tiers.items():
+            params = self.tier_params(tier)
+            for batch in self.chunk(tier_items, self.opt.max_batch):
+                started = time.perf_counter()
+                output = self.generate_items(batch, params, preview_url)
+                item_seconds = (time.perf_counter() - started) / len(batch)
+
+                for user_id, images in output:
+                    ITEM_SECONDS.observe(item_seconds, tier=params["tier"])
+                    if images is None:
+                        ITEMS.inc(result="error")
+                        yield {"id": user_id, "error": "Can't create images"}
+                        continue
+
+                    ITEMS.inc(result="ok")
+                    yield {
                         "id": user_id,
                         "images": {
-                            str(ind): img.flatten().tolist()
+                            str(ind): self.encode(img, image_format)
                             for ind, img in enumerate(images)
                         },
                     }
-                )
-            except:
-                self.logger.error(f"Can't create images for text '{text}'")
-                output.append({"id": user_id, "error": "Can't create images"})
 
-        return {"data": output, "result": len(output)}
+    @staticmethod
+    def encode(img, image_format):
+        with ENCODE_SECONDS.time(format=image_format):
+            return encode_image(img, image_format)
+
+    def generate_items(self, batch, params, preview_url=None):
+        on_preview = None
+        if preview_url:
+
+            def on_preview(ind, step, img):
+                user_id = batch[ind][0]
+                steps = params["ddim_steps"]
+                self.previews.send(preview_url, user_id, step, steps, img)
+
+        try:
+            with self.lock:
+                images = self.generate_batch(
+                    [text for _, text in batch], params, on_preview
+                )
+            return [(user_id, imgs) for (user_id, _), imgs in zip(batch, images)]
+        except:
+            self.logger.error(traceback.format_exc())
+
+        if len(batch) == 1:
+            user_id, text = batch[0]
+            self.logger.error(f"Can't create images for text '{text}'")
+            return [(user_id, None)]
+
+        # retry one by one, so a single bad item doesn't fail the whole batch
+        self.logger.info(f"Batch of {len(batch)} items failed, retrying separately")
+        RETRIES.inc()
+        output = []
+        for item in batch:
+            output += self.generate_items([item], params, preview_url)
+        return output
 
     @staticmethod
     def chunk(it, size):
@@ -124,83 +307,108 @@ class KFStableDiffusionModel(kfserving.KFModel):
             self.logger.warning("unexpected keys:")
             self.logger.warning(u)
 
-        model.cuda()
-        model.eval()
+        return self.backend.prepare(model)
+
+    def load_fp16_model(self, config, path, verbose=False):
+        # weights from weights.py, the full-precision checkpoint is never read,
+        # the model is built in its final dtype and the fp16 tensors are copied
+        # into it from the mapped file
+        self.logger.info(f"Loading fp16 weights from {path}")
+        model, m, u = build_fp16_model(
+            lambda: instantiate_from_config(config.model), path, self.backend
+        )
+        if len(m) > 0 and verbose:
+            self.logger.warning("missing keys:")
+            self.logger.warning(m)
+        if len(u) > 0 and verbose:
+            self.logger.warning("unexpected keys:")
+            self.logger.warning(u)
+
         return model
 
     def generate(self, prompt):
-        device = "cuda"
-        if self.opt.plms:
-            sampler = PLMSSampler(self.model)
-        else:
-            sampler = DDIMSampler(self.model)
-        images = []
-
-        batch_size = self.opt.n_samples
         if not self.opt.from_file:
             assert prompt is not None
-            data = [batch_size * [prompt]]
+            return self.generate_batch([prompt])[0]
 
-        else:
-            self.logger.info(f"reading prompts from {self.opt.from_file}")
-            with open(self.opt.from_file, "r") as f:
-                data = f.read().splitlines()
-                data = list(self.chunk(data, batch_size))
-
-        start_code = None
-        if self.opt.fixed_code:
-            start_code = torch.randn(
-                [
-                    self.opt.n_samples,
-                    self.opt.C,
-                    self.opt.H // self.opt.f,
-                    self.opt.W // self.opt.f,
-                ],
-                device=device,
+        self.logger.info(f"reading prompts from {self.opt.from_file}")
+        with open(self.opt.from_file, "r") as f:
+            data = f.read().splitlines()
+
+        images = []
+        for prompts in tqdm(list(self.chunk(data, self.opt.max_batch)), desc="data"):
+            for prompt_images in self.generate_batch(list(prompts)):
+                images += prompt_images
+        return images
+
+    def generate_batch(self, prompts, params=None, on_preview=None):
+        images = [[] for _ in prompts]
+        params = params or self.tier_params()
+
+        # every prompt gets n_samples images, all of them are sampled at once
+        n_samples = params["n_samples"]
+        batch_size = len(prompts) * n_samples
+
+        # cheap previews from the latents instead of decode_first_stage
+        img_callback = None
+        if on_preview is not None:
+            img_callback = make_img_callback(
+                self.opt.preview_every, len(prompts), n_samples, on_preview
             )
 
-        precision_scope = autocast if self.opt.precision == "autocast" else nullcontext
-        with torch.no_grad():
-            with precision_scope():
+        start_code = self.get_start_code(params)
+        if start_code is not None:
+            start_code = start_code.repeat(len(prompts), 1, 1, 1)
+
+        with self.backend.inference_scope():
+            with self.backend.precision_scope():
                 with self.model.ema_scope():
                     for _ in trange(self.opt.n_iter, desc="Sampling"):
-                        for prompts in tqdm(data, desc="data"):
-                            uc = None
-                            if self.opt.scale != 1.0:
-                                uc = self.model.get_learned_conditioning(
-                                    batch_size * [""]
-                                )
-                            if isinstance(prompts, tuple):
-                                prompts = list(prompts)
-                            c = self.model.get_learned_conditioning(prompts)
-                            shape = [
-                                self.opt.C,
-                                self.opt.H // self.opt.f,
-                                self.opt.W // self.opt.f,
-                            ]
-                            samples_ddim, _ = sampler.sample(
-                                S=self.opt.ddim_steps,
-                                conditioning=c,
-                                batch_size=self.opt.n_samples,
-                                shape=shape,
-                                verbose=False,
-                                unconditional_guidance_scale=self.opt.scale,
-                                unconditional_conditioning=uc,
-                                eta=self.opt.ddim_eta,
-                                x_T=start_code,
+                        uc = None
+                        if self.opt.scale != 1.0:
+                            uc = self.conditioning.unconditional_conditioning(
+                                batch_size
                             )
-
-                            x_samples_ddim = self.model.decode_first_stage(samples_ddim)
-                            x_samples_ddim = torch.clamp(
-                                (x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0
+                        c = self.conditioning.conditioning(prompts, n_samples)
+                        shape = [
+                            self.opt.C,
+                            params["H"] // self.opt.f,
+                            params["W"] // self.opt.f,
+                        ]
+                        sampling_started = time.perf_counter()
+                        samples_ddim, _ = self.sampler.sample(
+                            S=params["ddim_steps"],
+                            conditioning=c,
+                            batch_size=batch_size,
+                            shape=shape,
+                            verbose=False,
+                            unconditional_guidance_scale=self.opt.scale,
+                            unconditional_conditioning=uc,
+                            eta=self.opt.ddim_eta,
+                            x_T=start_code,
+                            img_callback=img_callback,
+                        )
+                        self.backend.synchronize()
+                        STEP_SECONDS.observe(
+                            (time.perf_counter() - sampling_started)
+                            / params["ddim_steps"],
+                            tier=params["tier"],
+                        )
+
+                        x_samples_ddim = self.model.decode_first_stage(samples_ddim)
+                        x_samples_ddim = torch.clamp(
+                            (x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0
+                        )
+
+                        for ind, x_sample in enumerate(x_samples_ddim):
+                            x_sample = 255.0 * rearrange(
+                                x_sample.float().cpu().numpy(), "c h w -> h w c"
                             )
+                            images[ind // n_samples] += [x_sample.astype(np.uint8)]
 
-                            for x_sample in x_samples_ddim:
-                                x_sample = 255.0 * rearrange(
-                                    x_sample.cpu().numpy(), "c h w -> h w c"
-                                )
-                                images += [x_sample.astype(np.uint8)]
-
+                    self.logger.debug(
+                        f"Conditioning cache: {self.conditioning.stats()}"
+                    )
                     return images
 
 
@@ -212,4 +420,4 @@ if __name__ == "__main__":
 
     model = KFStableDiffusionModel(name=service_name, conf_path="config.yaml")
     model.load()
-    kfserving.KFServer(workers=1).start([model])
+    StreamingKFServer(workers=1).start([model])
@@ -0,0 +1,85 @@
+import queue
+import logging
+import threading
+import traceback
+
+import numpy as np
+import requests
+
+from image_codec import FORMAT_PNG, encode_image
+
+# linear approximation of the VAE decoder for stable diffusion v1 latents,
+# latent channels -> RGB in [-1, 1]
+LATENT_RGB_FACTORS = np.array(
+    [
+        [0.298, 0.207, 0.208],
+        [0.187, 0.286, 0.173],
+        [-0.158, 0.189, 0.264],
+        [-0.184, -0.271, -0.473],
+    ],
+    dtype=np.float32,
+)
+
+QUEUE_SIZE = 32
+
+
+def latent_to_rgb(latent) -> np.ndarray:
+    # (C, h, w) latent -> (h, w, 3) image, the preview is 1/f of the image size
+    if hasattr(latent, "detach"):
+        latent = latent.detach().float().cpu().numpy()
+
+    rgb = np.einsum("chw,cr->hwr", latent.astype(np.float32), LATENT_RGB_FACTORS)
+    return (np.clip((rgb + 1.0) / 2.0, 0.0, 1.0) * 255.0).astype(np.uint8)
+
+
+def make_img_callback(every, n_prompts, n_samples, on_preview):
+    # sampler calls img_callback(pred_x0, step) after every step, the first
+    # sample of each prompt is shown
+    def img_callback(pred_x0, step):
+        if (step + 1) % every:
+            return
+
+        for ind in range(n_prompts):
+            on_preview(ind, step + 1, latent_to_rgb(pred_x0[ind * n_samples]))
+
+    return img_callback
+
+
+class PreviewSender:
+    # previews are posted from a background thread, sampling never waits for
+    # the network and previews are dropped when it can't keep up
+    def __init__(self, timeout: float, logger=None):
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.session = requests.Session()
+        self.thread = None
+
+    def send(self, url, user_id, step, steps, img):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        try:
+            self.queue.put_nowait((url, user_id, step, steps, img))
+        except queue.Full:
+            self.logger.debug(f"Preview queue is full, dropping preview for {user_id}")
+
+    def run(self):
+        while True:
+            url, user_id, step, steps, img = self.queue.get()
+            try:
+                response = self.session.post(
+                    url,
+                    json={
+                        "id": user_id,
+                        "step": step,
+                        "steps": steps,
+                        "image": encode_image(img, FORMAT_PNG),
+                    },
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+            except:
+                self.logger.debug(traceback.format_exc())
+                self.logger.info(f"Can't send preview for {user_id}")
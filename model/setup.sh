@@ -1,7 +1,7 @@
 git clone https://github.com/CompVis/stable-diffusion
 mkdir stable-diffusion/models/ldm/stable-diffusion-v1/
 mv model.ckpt stable-diffusion/models/ldm/stable-diffusion-v1/model.ckpt
-mv model_service.py config.yaml stable-diffusion/
+mv model_service.py conditioning.py image_codec.py previews.py streaming.py weights.py backend.py metrics.py test_batching.py config.yaml stable-diffusion/
 pip install -r requirements.txt
 cd stable-diffusion/
 pip install -e git+https://github.com/CompVis/taming-transformers.git@master#egg=taming-transformers
@@ -0,0 +1,70 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import kfserving
+import tornado.ioloop
+import tornado.web
+
+from metrics import CONTENT_TYPE, REGISTRY
+
+# generation runs here, the IOLoop keeps sending finished items meanwhile
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+class StreamPredictHandler(tornado.web.RequestHandler):
+    # same request as :predict, the response is NDJSON with one line per item
+    # written as soon as the item is ready
+    def initialize(self, models):
+        self.models = models
+
+    async def post(self, name: str):
+        model = self.models.get_model(name)
+        if model is None:
+            raise tornado.web.HTTPError(
+                status_code=HTTPStatus.NOT_FOUND,
+                reason=f"Model with name {name} does not exist.",
+            )
+
+        try:
+            request = json.loads(self.request.body)
+        except json.decoder.JSONDecodeError as e:
+            raise tornado.web.HTTPError(
+                status_code=HTTPStatus.BAD_REQUEST,
+                reason=f"Unrecognized request format: {e}",
+            )
+
+        loop = tornado.ioloop.IOLoop.current()
+        items = await loop.run_in_executor(EXECUTOR, model.predict_stream, request)
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        while True:
+            item = await loop.run_in_executor(EXECUTOR, next, items, None)
+            if item is None:
+                break
+
+            self.write(json.dumps(item) + "\n")
+            await self.flush()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(REGISTRY.render())
+
+
+class StreamingKFServer(kfserving.KFServer):
+    def create_application(self):
+        application = super().create_application()
+        application.add_handlers(
+            r".*",
+            [
+                (
+                    r"/v1/models/([a-zA-Z0-9_-]+):predict_stream",
+                    StreamPredictHandler,
+                    dict(models=self.registered_models),
+                ),
+                (r"/metrics", MetricsHandler),
+            ],
+        )
+        return application
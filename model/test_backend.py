@@ -0,0 +1,77 @@
+import time
+import logging
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+from backend import DeviceBackend
+
+
+def build_model(width):
+    # a few conv blocks at the latent resolution, like the unet, runs on cpu
+    layers = [torch.nn.Conv2d(4, width, 3, padding=1)]
+    for _ in range(4):
+        layers += [torch.nn.GroupNorm(32, width), torch.nn.SiLU()]
+        layers += [torch.nn.Conv2d(width, width, 3, padding=1)]
+    layers += [torch.nn.Conv2d(width, 4, 3, padding=1)]
+    return torch.nn.Sequential(*layers)
+
+
+def run(opt, args):
+    backend = DeviceBackend(opt, logging.getLogger(__name__))
+    model = backend.prepare(build_model(args.width))
+
+    x = torch.randn(args.batch, 4, args.size, args.size, device=backend.device)
+    if backend.channels_last:
+        x = x.to(memory_format=torch.channels_last)
+
+    with backend.inference_scope():
+        with backend.precision_scope():
+            model(x)
+
+            start = time.time()
+            for _ in range(args.steps):
+                y = model(x)
+            elapsed = (time.time() - start) / args.steps
+
+    print(
+        f"channels_last {backend.channels_last}, bf16 {backend.bf16}: "
+        f"{elapsed * 1000:.1f} ms per step, output {y.dtype}"
+    )
+    return y.float()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--width", type=int, default=128)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    torch.manual_seed(0)
+
+    opt = OmegaConf.load(args.config)
+    opt.device = args.device
+    opt.cpu.threads = args.threads
+
+    outputs = []
+    settings = [("full", False), ("full", True), ("autocast", True)]
+    for precision, channels_last in settings:
+        opt.precision = precision
+        opt.cpu.channels_last = channels_last
+        torch.manual_seed(0)
+        outputs.append(run(opt, args))
+
+    # bf16 changes the numbers a bit, the memory format must not
+    print(f"channels_last max diff {(outputs[0] - outputs[1]).abs().max():.2e}")
+    print(f"autocast max diff {(outputs[0] - outputs[2]).abs().max():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import base64
+import logging
+import argparse
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from backend import DeviceBackend
+from conditioning import ConditioningCache
+from model_service import KFStableDiffusionModel
+
+# a prompt is encoded as its number, images show it in the red channel and the
+# index of the sample in the batch in the green one
+PROMPTS = {"red": 1, "green": 2, "blue": 3, "cyan": 4, "bad": 5}
+SCALE = 25
+
+
+class FakeModel:
+    # conditioning and the first stage of the model, runs on CPU without weights
+    def get_learned_conditioning(self, prompts):
+        if "bad" in prompts:
+            raise RuntimeError("bad prompt")
+        return torch.tensor([[float(PROMPTS.get(prompt, 0))] for prompt in prompts])
+
+    def ema_scope(self):
+        return nullcontext()
+
+    def decode_first_stage(self, samples):
+        # 8 times larger, like the SD v1 decoder
+        img = samples[:, :3].repeat_interleave(8, dim=2).repeat_interleave(8, dim=3)
+        return img / SCALE * 2.0 - 1.0
+
+
+class FakeSampler:
+    # same interface as DDIMSampler.sample, the latents of each sample are its
+    # prompt number and its index in the batch
+    def __init__(self):
+        self.batch_sizes = []
+
+    def sample(self, S, conditioning, batch_size, shape, **kwargs):
+        self.batch_sizes.append(batch_size)
+
+        samples = torch.zeros(batch_size, *shape)
+        samples[:, 0] = conditioning[:, 0, None, None]
+        samples[:, 1] = torch.arange(batch_size, dtype=torch.float32)[:, None, None]
+        return samples, None
+
+
+def build_service(args):
+    service = KFStableDiffusionModel("test", args.config)
+    service.opt.device = service.device = "cpu"
+    service.opt.precision = "full"
+    service.opt.preview_every = 0
+
+    service.logger = logging.getLogger(__name__)
+    service.backend = DeviceBackend(service.opt, service.logger)
+    service.model = FakeModel()
+    service.sampler = FakeSampler()
+    service.conditioning = ConditioningCache(service.model, 16)
+    service.conditioning.load()
+    return service
+
+
+def decode(payload):
+    data = np.frombuffer(base64.b64decode(payload["data"]), dtype=payload["dtype"])
+    return data.reshape(payload["shape"])
+
+
+def run(service, prompts):
+    service.sampler.batch_sizes = []
+    items = [(f"id{ind}", prompt, None) for ind, prompt in enumerate(prompts)]
+    output = list(service.generate_results(items, "raw"))
+    assert [item["id"] for item in output] == [user_id for user_id, _, _ in items]
+    return output
+
+
+def check_images(service, item, prompt, first):
+    # images of an item are the samples first, first + 1, ... of its batch
+    opt = service.opt
+    shape = (opt.H // opt.f * 8, opt.W // opt.f * 8, 3)
+
+    assert len(item["images"]) == opt.n_samples
+    for ind in range(opt.n_samples):
+        img = decode(item["images"][str(ind)])
+        assert img.shape == shape, img.shape
+
+        values = np.rint(img[0, 0].astype(np.float32) * SCALE / 255)
+        assert values[0] == PROMPTS[prompt], (item["id"], values)
+        assert values[1] == first + ind, (item["id"], values)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yaml")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = build_service(args)
+    n_samples = service.opt.n_samples
+
+    # one sampler call for the whole batch, images are split back by prompt
+    prompts = ["red", "green", "blue"][: service.opt.max_batch]
+    output = run(service, prompts)
+    assert service.sampler.batch_sizes == [len(prompts) * n_samples]
+    for ind, (item, prompt) in enumerate(zip(output, prompts)):
+        check_images(service, item, prompt, ind * n_samples)
+    print(f"Batch of {len(prompts)}: sampler calls {service.sampler.batch_sizes}")
+
+    # a failed batch is retried item by item, only the bad item fails
+    prompts = ["red", "bad", "cyan"][: service.opt.max_batch]
+    output = run(service, prompts)
+    assert service.sampler.batch_sizes == [n_samples] * (len(prompts) - 1)
+    for item, prompt in zip(output, prompts):
+        if prompt == "bad":
+            assert "error" in item and "images" not in item
+        else:
+            check_images(service, item, prompt, 0)
+    print(f"Failed batch: sampler calls {service.sampler.batch_sizes}")
+
+
+if __name__ == "__main__":
+    main()
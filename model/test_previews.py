@@ -0,0 +1,57 @@
+import time
+import argparse
+
+import numpy as np
+
+from previews import PreviewSender, make_img_callback
+
+
+class FakeSampler:
+    # same interface as DDIMSampler.sample, latents move from noise to a
+    # fixed target, runs on CPU without the model
+    def __init__(self, step_time):
+        self.step_time = step_time
+
+    def sample(self, S, batch_size, shape, img_callback=None, **kwargs):
+        noise = np.random.randn(batch_size, *shape).astype(np.float32)
+        target = np.random.randn(1, *shape).astype(np.float32).repeat(batch_size, 0)
+
+        for step in range(S):
+            time.sleep(self.step_time)
+            alpha = (step + 1) / S
+            pred_x0 = alpha * target + (1 - alpha) * noise
+            if img_callback is not None:
+                img_callback(pred_x0, step)
+
+        return pred_x0, None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8070/preview")
+    parser.add_argument("--id", nargs="+", required=True)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--every", type=int, default=10)
+    parser.add_argument("--step-time", type=float, default=0.1)
+    args = parser.parse_args()
+
+    n_samples = 3
+    sender = PreviewSender(timeout=2)
+
+    def on_preview(ind, step, img):
+        print(f"Preview for {args.id[ind]}: step {step}, shape {img.shape}")
+        sender.send(args.url, args.id[ind], step, args.steps, img)
+
+    FakeSampler(args.step_time).sample(
+        S=args.steps,
+        batch_size=len(args.id) * n_samples,
+        shape=[4, 64, 64],
+        img_callback=make_img_callback(args.every, len(args.id), n_samples, on_preview),
+    )
+
+    # let the sender thread post the last previews
+    time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import torch
+from omegaconf import OmegaConf
+
+from backend import DeviceBackend
+from weights import build_fp16_model, convert_checkpoint, peak_rss_mb
+
+
+def build_model(n_layers, width):
+    # a stand-in for the diffusion model, runs on CPU
+    return torch.nn.Sequential(
+        *[torch.nn.Linear(width, width) for _ in range(n_layers)]
+    ).eval()
+
+
+def load_ckpt(args, backend):
+    # the old path of load_model_from_config: full-precision checkpoint, then
+    # the model is built and prepared
+    pl_sd = torch.load(args.ckpt, map_location="cpu")
+    model = build_model(args.layers, args.width)
+    model.load_state_dict(pl_sd["state_dict"])
+    return backend.prepare(model)
+
+
+def load_fp16(args, backend):
+    # the path of load_fp16_model
+    model, missing, unexpected = build_fp16_model(
+        lambda: build_model(args.layers, args.width), args.output, backend
+    )
+    assert not missing and not unexpected
+    return model
+
+
+def run_load(args):
+    opt = OmegaConf.load(args.config)
+    opt.device = args.device
+    backend = DeviceBackend(opt)
+
+    start = time.time()
+    if args.step == "ckpt":
+        model = load_ckpt(args, backend)
+    else:
+        model = load_fp16(args, backend)
+    backend.synchronize()
+    elapsed = time.time() - start
+
+    x = torch.ones(1, args.width, device=backend.device, dtype=backend.dtype)
+    with backend.inference_scope():
+        checksum = model(x).float().sum().item()
+    print(
+        f"{args.step}: {elapsed:.2f} s, peak RSS {peak_rss_mb():.0f} MB, "
+        f"{next(model.parameters()).dtype} on {backend.device}, "
+        f"checksum {checksum:.4f}"
+    )
+
+
+def convert(args):
+    os.makedirs(args.dir, exist_ok=True)
+    model = build_model(args.layers, args.width)
+    torch.save({"global_step": 0, "state_dict": model.state_dict()}, args.ckpt)
+
+    start = time.time()
+    convert_checkpoint(args.ckpt, args.output)
+    print(f"Converted in {time.time() - start:.2f} s")
+    for path in (args.ckpt, args.output):
+        print(f"{path}: {os.path.getsize(path) / 2 ** 20:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default="test_weights")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--layers", type=int, default=16)
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--step", choices=["convert", "ckpt", "fp16"], default=None)
+    args = parser.parse_args()
+
+    args.ckpt = os.path.join(args.dir, "model.ckpt")
+    args.output = os.path.join(args.dir, "model.fp16.safetensors")
+
+    if args.step == "convert":
+        convert(args)
+    elif args.step is not None:
+        run_load(args)
+    else:
+        # every step in its own process, peak RSS is kept across fork and exec
+        # so this one stays small. The checksums differ only by the fp16
+        # rounding of the weights, on cpu the model is fp32
+        for step in ("convert", "ckpt", "fp16"):
+            subprocess.run([sys.executable, __file__, *sys.argv[1:], "--step", step])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import time
+import argparse
+import resource
+
+import torch
+from omegaconf import OmegaConf
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = save_file = None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fp16_state_dict(state_dict):
+    # safetensors can't store shared or non-contiguous tensors, every value is
+    # copied once while the floating ones are cast to half precision
+    output = {}
+    for key, value in state_dict.items():
+        if value.is_floating_point():
+            value = value.half()
+        output[key] = value.contiguous().clone()
+    return output
+
+
+def has_fp16_weights(path):
+    return bool(path) and safe_open is not None and os.path.exists(path)
+
+
+@torch.no_grad()
+def load_fp16_weights(model, path):
+    # tensors are read one at a time from the memory-mapped file and copied
+    # into the model, so only one of them is in memory besides the model
+    state_dict = model.state_dict()
+    with safe_open(path, framework="pt") as fp:
+        keys = set(fp.keys())
+        for key in keys & state_dict.keys():
+            state_dict[key].copy_(fp.get_tensor(key))
+
+    missing = sorted(state_dict.keys() - keys)
+    unexpected = sorted(keys - state_dict.keys())
+    return missing, unexpected
+
+
+def build_fp16_model(build, path, backend):
+    # build creates the modules, they get the dtype and the device of the
+    # backend right away instead of a full-precision copy on the host
+    with backend.init_scope():
+        model = build()
+    missing, unexpected = load_fp16_weights(model, path)
+    return backend.prepare(model), missing, unexpected
+
+
+def convert_checkpoint(ckpt, path):
+    if save_file is None:
+        raise RuntimeError("safetensors is not installed, run pip install safetensors")
+
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    state_dict = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+    state_dict = fp16_state_dict(state_dict)
+    del pl_sd
+
+    metadata = {"source": os.path.basename(ckpt), "dtype": "float16"}
+
+    # the model prefers this file when it exists, so it appears only when full
+    tmp_path = f"{path}.tmp"
+    save_file(state_dict, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+    return len(state_dict)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--ckpt", default=None)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    opt = OmegaConf.load(args.config)
+    ckpt = args.ckpt or opt.ckpt
+    output = args.output or opt.fp16_weights
+
+    start = time.time()
+    n_tensors = convert_checkpoint(ckpt, output)
+    print(
+        f"Saved {n_tensors} tensors to {output} in {time.time() - start:.1f} s, "
+        f"peak RSS {peak_rss_mb():.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
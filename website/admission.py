@@ -0,0 +1,115 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+import db
+from scheduler import estimate_wait, get_throughput
+
+# new jobs are deferred with 429 while the estimated wait for them is longer,
+# until throughput is measured only the queue length is limited
+MAX_WAIT_SECONDS = 15 * 60
+MAX_QUEUE_LENGTH = 500
+MIN_RETRY_AFTER_SECONDS = 10
+MAX_RETRY_AFTER_SECONDS = 10 * 60
+
+# token buckets: a session may submit SESSION_BURST prompts at once and one
+# more every SESSION_INTERVAL_SECONDS, an address is shared by many users
+SESSION_BURST = 3
+SESSION_INTERVAL_SECONDS = 30
+ADDRESS_BURST = 100
+ADDRESS_INTERVAL_SECONDS = 1
+MAX_BUCKETS = 100000
+
+# idle workers poll again in about the mean time between arrivals
+MIN_TASK_RETRY_SECONDS = 1
+MAX_TASK_RETRY_SECONDS = 30
+
+STATS = {"deferred": 0, "limited": 0}
+
+
+def clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+class TokenBuckets:
+    def __init__(self, burst, interval, max_buckets=MAX_BUCKETS):
+        self.burst = burst
+        self.interval = interval
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def tokens(self, key, now):
+        if key not in self.buckets:
+            return self.burst
+        tokens, updated = self.buckets[key]
+        return min(tokens + (now - updated) / self.interval, self.burst)
+
+    def wait_time(self, key):
+        with self.lock:
+            return max(1 - self.tokens(key, time.monotonic()), 0) * self.interval
+
+    def take(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self.buckets[key] = (self.tokens(key, now) - 1, now)
+            self.buckets.move_to_end(key)
+
+            # least recently used buckets are the fullest ones
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+
+_sessions = TokenBuckets(SESSION_BURST, SESSION_INTERVAL_SECONDS)
+_addresses = TokenBuckets(ADDRESS_BURST, ADDRESS_INTERVAL_SECONDS)
+
+
+def estimated_wait():
+    # seconds until a new job is done, None until throughput is measured
+    queue_length = db.get_queue_length()
+    return queue_length, estimate_wait(queue_length)
+
+
+def check_queue():
+    queue_length, wait = estimated_wait()
+
+    if wait is None:
+        if queue_length < MAX_QUEUE_LENGTH:
+            return 0
+        return MAX_RETRY_AFTER_SECONDS
+
+    if wait <= MAX_WAIT_SECONDS:
+        return 0
+    return clamp(
+        wait - MAX_WAIT_SECONDS, MIN_RETRY_AFTER_SECONDS, MAX_RETRY_AFTER_SECONDS
+    )
+
+
+def admit(address, user_id):
+    # seconds to wait before submitting again, 0 when the job is accepted
+    retry_after = check_queue()
+    if retry_after:
+        STATS["deferred"] += 1
+        return math.ceil(retry_after)
+
+    limits = [(_sessions, user_id), (_addresses, address)]
+    retry_after = max(buckets.wait_time(key) for buckets, key in limits)
+    if retry_after:
+        STATS["limited"] += 1
+        return math.ceil(retry_after)
+
+    for buckets, key in limits:
+        buckets.take(key)
+    return 0
+
+
+def task_retry_after():
+    arrivals_per_second = get_throughput()["arrivals_per_second"]
+    if arrivals_per_second <= 0:
+        return MAX_TASK_RETRY_SECONDS
+
+    return round(
+        clamp(1 / arrivals_per_second, MIN_TASK_RETRY_SECONDS, MAX_TASK_RETRY_SECONDS),
+        1,
+    )
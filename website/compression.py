@@ -0,0 +1,41 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAX_BODY_SIZE = 256 * 1024 * 1024
+
+if zstandard is not None:
+    DECOMPRESS_ERRORS = (zlib.error, zstandard.ZstdError)
+else:
+    DECOMPRESS_ERRORS = (zlib.error,)
+
+
+def decompress_body(data: bytes, encoding: str) -> bytes:
+    try:
+        return _decompress(data, encoding.strip().lower())
+    except DECOMPRESS_ERRORS as error:
+        raise ValueError(f"Can't decompress request body: {error}") from error
+
+
+def _decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == "identity":
+        return data
+
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = decompressor.decompress(data, MAX_BODY_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Request body is too large")
+        return body
+
+    if encoding == "zstd" and zstandard is not None:
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            body = reader.read(MAX_BODY_SIZE + 1)
+        if len(body) > MAX_BODY_SIZE:
+            raise ValueError("Request body is too large")
+        return body
+
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
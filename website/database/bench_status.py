@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+from datetime import datetime as dt
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+
+def create_database(path, n_rows):
+    conn = sqlite3.connect(path)
+    with open(SCHEMA_PATH) as fp:
+        conn.executescript(fp.read())
+    conn.executemany(
+        "INSERT INTO requests (id, stat, edited) VALUES (?, ?, ?)",
+        [(f"user{ind}", 1 + ind % 4, dt.now()) for ind in range(n_rows)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def old_get_status(path, user_id):
+    # what every route did before: a fresh connection in rollback-journal mode
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    data = conn.execute(
+        "SELECT stat FROM requests WHERE id = ? LIMIT 1", (user_id,)
+    ).fetchone()
+    conn.close()
+    return data["stat"] if data is not None else 0
+
+
+def old_write(path, user_id):
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE requests SET stat=2, edited=? WHERE id=?", (dt.now(), user_id))
+    conn.commit()
+    conn.close()
+
+
+def new_write(_path, user_id):
+    with db.transaction():
+        db.set_status([user_id], db.STAT_RUNNING)
+
+
+def run(get_status, write, path, n_rows, n_readers, seconds):
+    stop = threading.Event()
+    counts = [0] * n_readers
+    errors = [0]
+
+    def reader(ind):
+        user_ind = ind
+        while not stop.is_set():
+            try:
+                get_status(path, f"user{user_ind % n_rows}")
+                counts[ind] += 1
+            except sqlite3.OperationalError:
+                errors[0] += 1
+            user_ind += n_readers
+
+    def writer():
+        user_ind = 0
+        while not stop.is_set():
+            try:
+                write(path, f"user{user_ind % n_rows}")
+            except sqlite3.OperationalError:
+                errors[0] += 1
+            user_ind += 1
+
+    threads = [threading.Thread(target=reader, args=(ind,)) for ind in range(n_readers)]
+    threads.append(threading.Thread(target=writer))
+
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / seconds, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Status query throughput with a concurrent writer"
+    )
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        old_path = os.path.join(tmp_dir, "old.db")
+        new_path = os.path.join(tmp_dir, "new.db")
+        create_database(old_path, args.rows)
+        create_database(new_path, args.rows)
+
+        db.configure(new_path)
+
+        old_rate, old_errors = run(
+            old_get_status, old_write, old_path, args.rows, args.readers, args.seconds
+        )
+        new_rate, new_errors = run(
+            lambda _path, user_id: db.get_status(user_id),
+            new_write,
+            new_path,
+            args.rows,
+            args.readers,
+            args.seconds,
+        )
+
+    print(f"readers: {args.readers}, rows: {args.rows}, one concurrent writer")
+    for name, rate, errors in [
+        ("before (connect per query, rollback journal)", old_rate, old_errors),
+        ("after (pooled connections, WAL)", new_rate, new_errors),
+    ]:
+        print(f"{name:46} {rate:10.0f} q/s, {errors} errors")
+    print(f"speedup: {new_rate / old_rate:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import sqlite3
+from datetime import datetime as dt
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+storage.configure(backend="local", root_dir="..")
+
+REQUESTS_COLUMNS = {
+    "cache_key": "TEXT",
+    "worker": "TEXT",
+    "prompt": "TEXT",
+    "params": "TEXT",
+    "n_images": "INTEGER",
+    "images": "TEXT",
+    "created": "TIMESTAMP",
+    "started": "TIMESTAMP",
+    "finished": "TIMESTAMP",
+    "sched_key": "REAL",
+    "progress": "INTEGER",
+}
+
+connection = sqlite3.connect("database.db")
+connection.row_factory = sqlite3.Row
+
+cur = connection.cursor()
+
+# bring a database created by an older schema.sql up to date
+existing = {row["name"] for row in cur.execute("PRAGMA table_info(requests)")}
+for column, column_type in REQUESTS_COLUMNS.items():
+    if column not in existing:
+        cur.execute(f"ALTER TABLE requests ADD COLUMN {column} {column_type}")
+        print(f"Added column {column}")
+
+cur.executescript("""
+    CREATE INDEX IF NOT EXISTS requests_cache_key ON requests (cache_key, stat);
+    CREATE INDEX IF NOT EXISTS requests_stat ON requests (stat, created);
+    CREATE INDEX IF NOT EXISTS requests_edited ON requests (edited);
+    CREATE INDEX IF NOT EXISTS requests_sched ON requests (stat, sched_key);
+    CREATE INDEX IF NOT EXISTS requests_created ON requests (created);
+
+    CREATE TABLE IF NOT EXISTS result_cache (
+        key TEXT PRIMARY KEY NOT NULL,
+        n_images INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        used TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        hits INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS result_cache_used ON result_cache (used);
+    """)
+
+cur.execute("UPDATE requests SET created = edited WHERE created IS NULL")
+cur.execute(
+    "UPDATE requests SET sched_key = (julianday(created, 'utc') - 2440587.5) * 86400 "
+    "WHERE sched_key IS NULL"
+)
+
+# move session and cache directories from the flat layout into shards
+moved = 0
+for local_storage in (storage.user_data(), storage.result_cache()):
+    if not os.path.isdir(local_storage.root):
+        continue
+
+    for name in os.listdir(local_storage.root):
+        path = os.path.join(local_storage.root, name)
+        if len(name) <= 2 or not os.path.isdir(path):
+            continue
+
+        new_path = local_storage.group_dir(name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.rename(path, new_path)
+        moved += 1
+
+print(f"Moved {moved} directories into the sharded layout")
+
+rows = cur.execute("SELECT id, stat FROM requests WHERE prompt IS NULL").fetchall()
+
+imported = 0
+for row in rows:
+    user_dir = storage.user_data().group_dir(row["id"])
+    text_path = os.path.join(user_dir, "text.txt")
+
+    if not os.path.isfile(text_path):
+        continue
+
+    with open(text_path, "r", encoding="utf-8") as fp:
+        prompt = fp.read()
+
+    images = sorted(
+        (
+            name
+            for name in os.listdir(user_dir)
+            if name.startswith("img_") and name.endswith(".png")
+        ),
+        key=lambda name: int(name[len("img_") : -len(".png")]),
+    )
+
+    n_images, images_json, finished = None, None, None
+    if row["stat"] == 3:
+        n_images, images_json = len(images), json.dumps(images)
+        finished = dt.fromtimestamp(os.path.getmtime(text_path))
+        if images:
+            finished = dt.fromtimestamp(
+                max(os.path.getmtime(os.path.join(user_dir, name)) for name in images)
+            )
+
+    cur.execute(
+        "UPDATE requests SET prompt = ?, n_images = ?, images = ?, finished = ? "
+        "WHERE id = ?",
+        (prompt, n_images, images_json, finished, row["id"]),
+    )
+    imported += 1
+
+connection.commit()
+connection.close()
+
+print(f"Imported {imported} of {len(rows)} sessions without prompt")
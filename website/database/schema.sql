@@ -1,7 +1,36 @@
 DROP TABLE IF EXISTS requests;
+DROP TABLE IF EXISTS result_cache;
 
 CREATE TABLE requests (
     id TEXT PRIMARY KEY NOT NULL,
     stat INTEGER NOT NULL,
-    edited TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    edited TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    cache_key TEXT,
+    worker TEXT,
+    prompt TEXT,
+    params TEXT,
+    n_images INTEGER,
+    images TEXT,
+    created TIMESTAMP,
+    started TIMESTAMP,
+    finished TIMESTAMP,
+    sched_key REAL,
+    progress INTEGER
 );
+
+CREATE INDEX requests_cache_key ON requests (cache_key, stat);
+CREATE INDEX requests_stat ON requests (stat, created);
+CREATE INDEX requests_edited ON requests (edited);
+CREATE INDEX requests_sched ON requests (stat, sched_key);
+CREATE INDEX requests_created ON requests (created);
+
+CREATE TABLE result_cache (
+    key TEXT PRIMARY KEY NOT NULL,
+    n_images INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    used TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX result_cache_used ON result_cache (used);
@@ -0,0 +1,322 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+DB_PATH = "database/database.db"
+
+BUSY_TIMEOUT_SECONDS = 30
+
+# request states, see README
+STAT_QUEUED = 1
+STAT_RUNNING = 2
+STAT_DONE = 3
+STAT_ERROR = 4
+STAT_EXPIRED = 5
+
+_local = threading.local()
+
+
+def configure(path):
+    global DB_PATH
+    DB_PATH = path
+
+
+def connect(path=None):
+    # autocommit mode, multi-statement writes use transaction()
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        timeout=BUSY_TIMEOUT_SECONDS,
+        isolation_level=None,
+    )
+    conn.row_factory = sqlite3.Row
+
+    # readers don't wait for writers in WAL mode
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_SECONDS * 1000}")
+
+    return conn
+
+
+def get_connection():
+    # one connection per thread, reused between requests
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = connect()
+        _local.conn = conn
+        _local.path = DB_PATH
+    return conn
+
+
+@contextmanager
+def transaction():
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def query_one(sql, params=()):
+    return get_connection().execute(sql, params).fetchone()
+
+
+def query_all(sql, params=()):
+    return get_connection().execute(sql, params).fetchall()
+
+
+def execute(sql, params=()):
+    return get_connection().execute(sql, params).rowcount
+
+
+# requests
+
+
+def get_status(user_id):
+    data = query_one("SELECT stat FROM requests WHERE id = ? LIMIT 1", (user_id,))
+    return data["stat"] if data is not None else 0
+
+
+def get_request(user_id, stat=None):
+    if stat is None:
+        return query_one("SELECT * FROM requests WHERE id = ? LIMIT 1", (user_id,))
+    return query_one(
+        "SELECT * FROM requests WHERE id = ? AND stat = ? LIMIT 1", (user_id, stat)
+    )
+
+
+def get_images(data):
+    return json.loads(data["images"]) if data["images"] else []
+
+
+def save_request(user_id, stat, cache_key, prompt, params, sched_key, images=None):
+    now = dt.now()
+    finished = now if stat == STAT_DONE else None
+    execute(
+        "INSERT INTO requests (id, stat, edited, cache_key, worker, prompt, params, "
+        "n_images, images, created, started, finished, sched_key, progress) "
+        "VALUES (?, ?, ?, ?, NULL, ?, ?, ?, ?, ?, NULL, ?, ?, NULL) "
+        "ON CONFLICT (id) DO UPDATE SET stat=excluded.stat, edited=excluded.edited, "
+        "cache_key=excluded.cache_key, worker=NULL, prompt=excluded.prompt, "
+        "params=excluded.params, n_images=excluded.n_images, "
+        "images=excluded.images, created=excluded.created, started=NULL, "
+        "finished=excluded.finished, sched_key=excluded.sched_key, progress=NULL",
+        (
+            user_id,
+            stat,
+            now,
+            cache_key,
+            prompt,
+            json.dumps(params),
+            len(images) if images is not None else None,
+            json.dumps(images) if images is not None else None,
+            now,
+            finished,
+            sched_key,
+        ),
+    )
+
+
+def is_running(cache_key):
+    data = query_one(
+        "SELECT id FROM requests WHERE cache_key = ? AND stat = ? LIMIT 1",
+        (cache_key, STAT_RUNNING),
+    )
+    return data is not None
+
+
+def get_queued(limit):
+    # in scheduling order, requests with the same prompt are claimed together
+    # with the first one and skipped later
+    return query_all(
+        "SELECT id, prompt, params FROM requests WHERE stat = ? "
+        "ORDER BY sched_key LIMIT ?",
+        (STAT_QUEUED, limit),
+    )
+
+
+def get_queue_position(sched_key):
+    data = query_one(
+        "SELECT COUNT(*) AS position FROM requests WHERE stat = ? AND sched_key < ?",
+        (STAT_QUEUED, sched_key),
+    )
+    return data["position"]
+
+
+def get_queue_length():
+    data = query_one(
+        "SELECT COUNT(*) AS length FROM requests WHERE stat = ?", (STAT_QUEUED,)
+    )
+    return data["length"]
+
+
+def get_status_counts():
+    rows = query_all("SELECT stat, COUNT(*) AS count FROM requests GROUP BY stat")
+    return {row["stat"]: row["count"] for row in rows}
+
+
+def get_arrivals(since):
+    # number of new requests and the time of the first one
+    return query_one(
+        "SELECT COUNT(*) AS arrivals, MIN(created) AS first "
+        "FROM requests WHERE created > ?",
+        (since,),
+    )
+
+
+def get_recent_jobs(since):
+    # jobs done by workers, cache hits and followers are not counted
+    return query_all(
+        "SELECT IFNULL(cache_key, id) AS job, MIN(started) AS started, "
+        "MAX(finished) AS finished FROM requests "
+        "WHERE stat = ? AND finished > ? AND started IS NOT NULL GROUP BY job",
+        (STAT_DONE, since),
+    )
+
+
+def claim_request(user_id, worker_id):
+    now = dt.now()
+    claimed = execute(
+        "UPDATE requests SET stat = ?, edited = ?, started = ?, worker = ? "
+        "WHERE id = ? AND stat = ?",
+        (STAT_RUNNING, now, now, worker_id, user_id, STAT_QUEUED),
+    )
+    return claimed == 1
+
+
+def claim_followers(user_id, worker_id):
+    now = dt.now()
+    return execute(
+        "UPDATE requests SET stat = ?, edited = ?, started = ?, worker = ? "
+        "WHERE stat = ? AND "
+        "cache_key IN (SELECT cache_key FROM requests WHERE id = ?)",
+        (STAT_RUNNING, now, now, worker_id, STAT_QUEUED, user_id),
+    )
+
+
+def get_followers(cache_key, user_id):
+    rows = query_all(
+        "SELECT id FROM requests WHERE cache_key = ? AND stat = ? AND id != ?",
+        (cache_key, STAT_RUNNING, user_id),
+    )
+    return [row["id"] for row in rows]
+
+
+def set_status(user_ids, stat):
+    now = dt.now()
+    get_connection().executemany(
+        "UPDATE requests SET stat = ?, edited = ?, finished = ? WHERE id = ?",
+        [(stat, now, now, user_id) for user_id in user_ids],
+    )
+
+
+def set_progress(user_ids, progress):
+    # only running requests, a late preview must not touch a finished one
+    get_connection().executemany(
+        "UPDATE requests SET progress = ? WHERE id = ? AND stat = ?",
+        [(progress, user_id, STAT_RUNNING) for user_id in user_ids],
+    )
+
+
+def set_done(user_ids, images):
+    now = dt.now()
+    get_connection().executemany(
+        "UPDATE requests SET stat = ?, edited = ?, finished = ?, n_images = ?, "
+        "images = ? WHERE id = ?",
+        [
+            (STAT_DONE, now, now, len(images), json.dumps(images), user_id)
+            for user_id in user_ids
+        ],
+    )
+
+
+def fail_stale_running(started_before, limit):
+    # jobs of a crashed worker or lost on the way to storage never finish
+    now = dt.now()
+    return execute(
+        "UPDATE requests SET stat = ?, edited = ?, finished = ? WHERE id IN ("
+        "SELECT id FROM requests WHERE stat = ? AND edited < ? LIMIT ?)",
+        (STAT_ERROR, now, now, STAT_RUNNING, started_before, limit),
+    )
+
+
+def mark_expired(older_than, stale_before, limit):
+    # jobs in the queue or on a worker are only expired when they are stale
+    return execute(
+        "UPDATE requests SET stat = ?, edited = ? WHERE id IN ("
+        "SELECT id FROM requests WHERE edited < ? AND stat != ? AND "
+        "(stat NOT IN (?, ?) OR edited < ?) LIMIT ?)",
+        (
+            STAT_EXPIRED,
+            dt.now(),
+            older_than,
+            STAT_EXPIRED,
+            STAT_QUEUED,
+            STAT_RUNNING,
+            stale_before,
+            limit,
+        ),
+    )
+
+
+def expire_oldest_finished(limit):
+    return execute(
+        "UPDATE requests SET stat = ?, edited = ? WHERE id IN ("
+        "SELECT id FROM requests WHERE stat IN (?, ?) ORDER BY edited LIMIT ?)",
+        (STAT_EXPIRED, dt.now(), STAT_DONE, STAT_ERROR, limit),
+    )
+
+
+def get_ids(stat=None, limit=-1):
+    if stat is None:
+        return {row["id"] for row in query_all("SELECT id FROM requests")}
+    rows = query_all("SELECT id FROM requests WHERE stat = ? LIMIT ?", (stat, limit))
+    return {row["id"] for row in rows}
+
+
+def delete_requests(user_ids):
+    get_connection().executemany(
+        "DELETE FROM requests WHERE id = ?", [(user_id,) for user_id in user_ids]
+    )
+
+
+# result cache
+
+
+def get_cache_entry(key):
+    return query_one("SELECT * FROM result_cache WHERE key = ? LIMIT 1", (key,))
+
+
+def touch_cache_entry(key):
+    execute(
+        "UPDATE result_cache SET used = ?, hits = hits + 1 WHERE key = ?",
+        (dt.now(), key),
+    )
+
+
+def save_cache_entry(key, n_images, size):
+    execute(
+        "INSERT OR REPLACE INTO result_cache (key, n_images, size, created, used, hits) "
+        "VALUES (?, ?, ?, ?, ?, 0)",
+        (key, n_images, size, dt.now(), dt.now()),
+    )
+
+
+def delete_cache_entry(key):
+    execute("DELETE FROM result_cache WHERE key = ?", (key,))
+
+
+def get_cache_totals():
+    data = query_one("SELECT COUNT(*) AS entries, SUM(size) AS size FROM result_cache")
+    return data["entries"], data["size"] or 0
+
+
+def get_cache_lru():
+    return query_all("SELECT key, size FROM result_cache ORDER BY used")
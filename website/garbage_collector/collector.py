@@ -1,90 +1,203 @@
 import os
+import sys
 import time
-import shutil
-import sqlite3
 import traceback
+from collections import deque
 from datetime import datetime, timedelta
 
 from logger import get_logger
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import storage  # noqa: E402
+
+# finished sessions are removed after TIMEOUT_MINUTES without changes, queued
+# jobs only after STALE_MINUTES. Running jobs fail after RUNNING_MINUTES counted
+# from the claim, their sessions may submit again. With the defaults of
+# worker/worker_config.yaml a claimed job may wait for the batch before it
+# (pipeline.queue_depth), each batch takes up to model_retries * (timeout +
+# model_sleep_time) = 3 * 1010 s, then its upload waits for upload_queue_depth
+# others, each up to sending_results_retries * timeout = 50 * 10 s, so the
+# worst case is 2 * 3030 + 5 * 500 s, about 143 minutes
 TIMEOUT_MINUTES = 30
+STALE_MINUTES = 24 * 60
+RUNNING_MINUTES = 3 * 60
+
+# small ticks with bounded work instead of one sweep of everything
+TICK_SECONDS = 10
+BATCH_SIZE = 100
+DELETES_PER_SECOND = 20
+
+# stored sessions are compared with the database every RECONCILE_SECONDS, fresh
+# ones may be created just before their row and are left alone for a while
+RECONCILE_SECONDS = 5 * 60
+ORPHAN_GRACE_SECONDS = 10 * 60
+
+# oldest finished sessions are removed while results take more, 0 disables
+DISK_BUDGET_BYTES = 0
+
+db.configure("../database/database.db")
+storage.configure(root_dir="..")
+
+
+class Throttle:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0.0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next_time:
+            time.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + self.interval
+
+
+def remove_dir(name, state):
+    state["throttle"].wait()
+    storage.user_data().remove(name)
+
+    _, size = state["dirs"].pop(name, (0, 0))
+    state["usage"] -= size
+
+
+def mark_rows(state):
+    now = datetime.now()
+    return db.mark_expired(
+        now - timedelta(minutes=TIMEOUT_MINUTES),
+        now - timedelta(minutes=STALE_MINUTES),
+        BATCH_SIZE,
+    )
+
+
+def fail_running_rows(state):
+    started_before = datetime.now() - timedelta(minutes=RUNNING_MINUTES)
+    return db.fail_stale_running(started_before, BATCH_SIZE)
+
+
+def remove_marked_rows(state):
+    with db.transaction():
+        rows_for_delete = db.get_ids(db.STAT_EXPIRED, BATCH_SIZE)
+        db.delete_requests(rows_for_delete)
+
+    for folder in rows_for_delete:
+        remove_dir(folder, state)
 
+    return len(rows_for_delete)
 
-def get_db_connection():
-    conn = sqlite3.connect("../database/database.db")
-    conn.row_factory = sqlite3.Row
-    return conn
 
-def mark_rows():
-    conn = get_db_connection()
-    cur = conn.cursor()
+def reconcile(state, logger):
+    started = time.monotonic()
 
-    cur.execute(
-        "UPDATE requests SET stat=5, edited=? WHERE edited < ?", 
-        (
-            datetime.now(),
-            datetime.now() - timedelta(minutes=TIMEOUT_MINUTES)
+    # set difference of one storage listing and one query
+    dirs = {
+        name: (mtime, size)
+        for name, mtime, size in storage.user_data().groups(
+            with_sizes=DISK_BUDGET_BYTES > 0
         )
+    }
+    usage = sum(size for _, size in dirs.values())
+    existed = db.get_ids()
+
+    now = time.time()
+    state["orphans"] = deque(
+        name
+        for name in dirs.keys() - existed
+        if now - dirs[name][0] > ORPHAN_GRACE_SECONDS
+    )
+    state["dirs"] = dirs
+    state["usage"] = usage
+    state["last_reconcile"] = time.monotonic()
+
+    logger.info(
+        "Reconciled %d sessions, %d orphaned, %.1f MB in %.3f s",
+        len(dirs),
+        len(state["orphans"]),
+        usage / 1024 / 1024,
+        time.monotonic() - started,
     )
 
-    conn.commit()
-    conn.close()
 
-def remove_marked_rows(logger):
-    conn = get_db_connection()
-    cur = conn.cursor()
+def remove_not_existed_rows(state):
+    removed = 0
+    while state["orphans"] and removed < BATCH_SIZE:
+        name = state["orphans"].popleft()
 
-    cur.execute("SELECT id FROM requests WHERE stat=5")
+        # the session may have come back since the listing
+        if db.get_status(name) != 0:
+            continue
 
-    data = cur.fetchall()
-    rows_for_delete = [item["id"] for item in data]
+        remove_dir(name, state)
+        removed += 1
 
-    if rows_for_delete:
-        cur.execute("DELETE FROM requests WHERE stat=5")
+    return removed
 
-    conn.commit()
 
-    for folder in rows_for_delete:
-        shutil.rmtree(f"../user_data/{folder}")
-        logger.info("Remove marked session %s", folder)
+def evict_over_budget(state):
+    if DISK_BUDGET_BYTES <= 0 or state["usage"] <= DISK_BUDGET_BYTES:
+        return 0
+
+    # sizes are known per directory, rows are picked by age, so estimate
+    average = state["usage"] / max(len(state["dirs"]), 1)
+    n_sessions = int((state["usage"] - DISK_BUDGET_BYTES) / max(average, 1)) + 1
+
+    return db.expire_oldest_finished(min(n_sessions, BATCH_SIZE))
 
-    conn.close()
 
-def remove_not_existed_rows(logger):
-    dirs = os.listdir("../user_data/")
+def tick(state, logger):
+    started = time.monotonic()
+    counts = {}
+
+    stages = [
+        ("orphans", remove_not_existed_rows),
+        ("removed", remove_marked_rows),
+        ("failed", fail_running_rows),
+        ("expired", mark_rows),
+        ("evicted", evict_over_budget),
+    ]
+    for name, stage in stages:
+        try:
+            counts[name] = stage(state)
+        except:
+            logger.error(traceback.format_exc())
+            logger.info("Error in garbage collector stage %s", name)
+            counts[name] = 0
+
+    if any(counts.values()):
+        logger.info(
+            "Swept %s in %.3f s",
+            ", ".join(f"{name} {count}" for name, count in counts.items()),
+            time.monotonic() - started,
+        )
 
-    conn = get_db_connection()
-    cur = conn.cursor()
 
-    for dir_name in dirs:
-        cur.execute("SELECT * FROM requests WHERE id=? LIMIT 1", (dir_name, ))
-        data = cur.fetchone()
+def main():
+    logger = get_logger(__name__)
 
-        if not data:
-            shutil.rmtree(f"../user_data/{dir_name}")
-            logger.info("Remove not existed session %s", dir_name)
+    state = {
+        "throttle": Throttle(DELETES_PER_SECOND),
+        "orphans": deque(),
+        "dirs": {},
+        "usage": 0,
+        "last_reconcile": None,
+    }
 
-    conn.close()
+    while True:
+        if (
+            state["last_reconcile"] is None
+            or time.monotonic() - state["last_reconcile"] > RECONCILE_SECONDS
+        ):
+            try:
+                reconcile(state, logger)
+            except:
+                logger.error(traceback.format_exc())
+                logger.info("Error reconciling sessions")
+                state["last_reconcile"] = time.monotonic()
 
-logger = get_logger(__name__)
+        tick(state, logger)
 
-while True:
-    try:
-        remove_not_existed_rows(logger)
-    except:
-        logger.error(traceback.format_exc())
-        logger.info("Error removing nonexisting rows")
+        time.sleep(TICK_SECONDS)
 
-    try:
-        remove_marked_rows(logger)
-    except:
-        logger.error(traceback.format_exc())
-        logger.info("Error removing marked rows")
 
-    try:
-        mark_rows()
-    except:
-        logger.error(traceback.format_exc())
-        logger.info("Error marking rows")
-    
-    time.sleep(TIMEOUT_MINUTES * 60)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import io
+import base64
+import struct
+
+import numpy as np
+from PIL import Image
+
+FORMAT_LIST = "list"
+FORMAT_RAW = "raw"
+FORMAT_PNG = "png"
+
+SUPPORTED_FORMATS = (FORMAT_PNG, FORMAT_RAW, FORMAT_LIST)
+
+LEGACY_SHAPE = (512, 512, 3)
+
+RAW_DTYPE = "uint8"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# base64 characters that cover the signature and the IHDR chunk
+PNG_HEADER_CHARS = 32
+
+
+def decode_image(payload, shape=LEGACY_SHAPE) -> np.ndarray:
+    if isinstance(payload, list):
+        return np.array(payload, dtype=np.uint8).reshape(shape)
+
+    image_format = payload["format"]
+    data = base64.b64decode(payload["data"])
+
+    if image_format == FORMAT_RAW:
+        img = np.frombuffer(data, dtype=np.dtype(payload["dtype"]))
+        return img.reshape(payload["shape"])
+
+    if image_format == FORMAT_PNG:
+        with Image.open(io.BytesIO(data)) as img:
+            return np.asarray(img)
+
+    raise ValueError(f"Unknown image format '{image_format}'")
+
+
+def png_size(data: bytes):
+    # width and height from the IHDR chunk, which must follow the signature
+    if len(data) < 24 or data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        raise ValueError("Invalid PNG image")
+    width, height = struct.unpack(">II", data[16:24])
+    return height, width
+
+
+def validate_image(payload, shape=LEGACY_SHAPE) -> None:
+    # cheap checks done before the result is acknowledged, decoding happens
+    # later, shape is None when the size of the image isn't known
+    if isinstance(payload, list):
+        if shape is None or len(payload) != int(np.prod(shape)):
+            raise ValueError("Invalid image size")
+        return
+
+    if not isinstance(payload, dict) or not isinstance(payload.get("data"), str):
+        raise ValueError("Invalid image payload")
+
+    image_format = payload.get("format")
+    if image_format not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unknown image format '{image_format}'")
+
+    if shape is not None and list(payload.get("shape", shape)) != list(shape):
+        raise ValueError(f"Image shape {payload['shape']} instead of {list(shape)}")
+
+    if image_format == FORMAT_PNG:
+        # only the header is decoded, it takes the first PNG_HEADER_CHARS
+        header = base64.b64decode(payload["data"][:PNG_HEADER_CHARS], validate=True)
+        size = png_size(header)
+        if shape is not None and size != tuple(shape[:2]):
+            raise ValueError(f"PNG size {size} instead of {tuple(shape[:2])}")
+        return
+
+    if image_format == FORMAT_RAW:
+        if payload.get("dtype") != RAW_DTYPE or "shape" not in payload:
+            raise ValueError(f"Raw images must be {RAW_DTYPE} with a shape")
+        size = len(base64.b64decode(payload["data"], validate=True))
+        if shape is None or size != int(np.prod(shape)):
+            raise ValueError("Invalid image size")
+        return
+
+    raise ValueError(f"Image format '{image_format}' needs a list payload")
+
+
+def encode_png(payload, shape=LEGACY_SHAPE) -> bytes:
+    # PNG bytes encoded on the GPU host are stored as is, without re-encoding
+    if isinstance(payload, dict) and payload.get("format") == FORMAT_PNG:
+        return base64.b64decode(payload["data"])
+
+    buffer = io.BytesIO()
+    Image.fromarray(decode_image(payload, shape)).save(buffer, format="PNG")
+    return buffer.getvalue()
@@ -0,0 +1,282 @@
+import os
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import db
+import storage
+from image_codec import LEGACY_SHAPE, encode_png
+from metrics import Histogram
+from notifier import STATUSES
+from renditions import make_previews
+from result_cache import clear_results, image_names, result_files, store
+
+# PNG encoding and writing run in separate processes, at most MAX_PENDING
+# results wait for them, send_task blocks up to QUEUE_TIMEOUT_SECONDS for a
+# free slot and then asks the worker to retry
+PROCESSES = 2
+MAX_PENDING = 16
+QUEUE_TIMEOUT_SECONDS = 10
+
+# a job is resubmitted to a new pool this many times when a pool process dies,
+# a payload that kills the process every time fails after that
+MAX_RESUBMITS = 2
+
+# window of finished jobs for throughput and latency
+STATS_WINDOW = 1000
+
+STATS = {
+    "accepted": 0,
+    "completed": 0,
+    "failed": 0,
+    "rejected": 0,
+    "resubmitted": 0,
+    "images": 0,
+}
+
+logger = logging.getLogger(__name__)
+
+PNG_ENCODE_SECONDS = Histogram(
+    "website_png_encode_seconds", "PNG encoding time of one result image"
+)
+
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+_lock = threading.Lock()
+_pending = set()
+_idle = threading.Condition(_lock)
+_history = deque(maxlen=STATS_WINDOW)
+_executor = None
+
+
+def python_executable():
+    # under uwsgi sys.executable is the uwsgi binary, spawned processes need
+    # the interpreter of the same environment
+    if os.path.basename(sys.executable).startswith("python"):
+        return sys.executable
+    return os.path.join(sys.exec_prefix, "bin", f"python{sys.version_info.major}")
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # don't fork the threaded server process
+            context = multiprocessing.get_context("spawn")
+            context.set_executable(python_executable())
+            _executor = ProcessPoolExecutor(PROCESSES, mp_context=context)
+        return _executor
+
+
+def reset_executor(executor):
+    # a pool stays broken after one of its processes died, the next job
+    # starts a new one
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def write_images(user_data, user_id, images, shape=LEGACY_SHAPE):
+    # runs in a pool process, the files are durable when it returns, the time
+    # of every encoding is returned too, metrics live in the server process
+    started = time.perf_counter()
+    encode_times = []
+
+    for name, payload in zip(image_names(len(images)), images):
+        encode_started = time.perf_counter()
+        data = encode_png(payload, shape)
+        encode_times.append(time.perf_counter() - encode_started)
+        user_data.save(user_id, name, data)
+
+        for preview_name, preview_data in make_previews(name, data):
+            user_data.save(user_id, preview_name, preview_data)
+    user_data.sync(user_id)
+
+    return time.perf_counter() - started, encode_times
+
+
+def is_pending(user_id):
+    with _lock:
+        return user_id in _pending
+
+
+def submit(user_id, images, shape=LEGACY_SHAPE):
+    # returns False if the queue is full or the result is already being written
+    if not _slots.acquire(timeout=QUEUE_TIMEOUT_SECONDS):
+        with _lock:
+            STATS["rejected"] += 1
+        return False
+
+    with _lock:
+        if user_id in _pending:
+            _slots.release()
+            return False
+        _pending.add(user_id)
+        STATS["accepted"] += 1
+
+    try:
+        start(user_id, images, shape, time.monotonic(), MAX_RESUBMITS)
+    except Exception:
+        finish(user_id)
+        raise
+    return True
+
+
+def start(user_id, images, shape, accepted, resubmits):
+    while True:
+        executor = get_executor()
+        try:
+            # the storage goes with the job, pool processes don't share our settings
+            future = executor.submit(
+                write_images, storage.user_data(), user_id, images, shape
+            )
+            break
+        except BrokenProcessPool:
+            reset_executor(executor)
+            if resubmits == 0:
+                raise
+            resubmits -= 1
+
+    future.add_done_callback(
+        lambda future: complete(
+            user_id, images, shape, accepted, resubmits, executor, future
+        )
+    )
+
+
+def complete(user_id, images, shape, accepted, resubmits, executor, future):
+    # runs in the executor thread once the pool process is done
+    n_images = len(images)
+    try:
+        encode_seconds, encode_times = future.result()
+        publish_done(user_id, image_names(n_images))
+    except BrokenProcessPool:
+        reset_executor(executor)
+        if resubmits > 0 and resubmit(user_id, images, shape, accepted, resubmits):
+            return
+        logger.error("Pool process died writing the images of %s", user_id)
+        fail(user_id)
+        finish(user_id)
+        return
+    except Exception:
+        logger.exception("Writing the images of %s failed", user_id)
+        fail(user_id)
+        finish(user_id)
+        return
+
+    for encode_time in encode_times:
+        PNG_ENCODE_SECONDS.observe(encode_time)
+
+    with _lock:
+        STATS["completed"] += 1
+        STATS["images"] += n_images
+        _history.append(
+            (time.monotonic(), time.monotonic() - accepted, encode_seconds, n_images)
+        )
+    finish(user_id)
+
+
+def resubmit(user_id, images, shape, accepted, resubmits):
+    # the job keeps its slot, the result was already acknowledged
+    logger.warning("Pool process died, writing the images of %s again", user_id)
+    try:
+        start(user_id, images, shape, accepted, resubmits - 1)
+    except Exception:
+        logger.exception("Resubmitting the images of %s failed", user_id)
+        return False
+
+    with _lock:
+        STATS["resubmitted"] += 1
+    return True
+
+
+def finish(user_id):
+    with _lock:
+        _pending.discard(user_id)
+        _idle.notify_all()
+    _slots.release()
+
+
+def publish_done(user_id, names):
+    data = db.get_request(user_id, db.STAT_RUNNING)
+    if data is None:
+        return
+
+    # followers are looked up only now, sessions may attach while images are written
+    followers = []
+    if data["cache_key"] is not None:
+        store(data["cache_key"], user_id, len(names))
+        followers = db.get_followers(data["cache_key"], user_id)
+
+    user_data = storage.user_data()
+    for follower_id in followers:
+        clear_results(follower_id)
+        user_data.copy(user_data, user_id, follower_id, result_files(names))
+
+    with db.transaction():
+        db.set_done([user_id] + followers, names)
+
+    for done_id in [user_id] + followers:
+        STATUSES.publish(done_id, db.STAT_DONE)
+
+
+def fail(user_id):
+    with _lock:
+        STATS["failed"] += 1
+
+    data = db.get_request(user_id, db.STAT_RUNNING)
+    if data is None:
+        return
+
+    error_users = [user_id]
+    if data["cache_key"] is not None:
+        error_users += db.get_followers(data["cache_key"], user_id)
+
+    with db.transaction():
+        db.set_status(error_users, db.STAT_ERROR)
+
+    for error_id in error_users:
+        STATUSES.publish(error_id, db.STAT_ERROR)
+
+
+def wait_idle(timeout=None):
+    with _lock:
+        return _idle.wait_for(lambda: not _pending, timeout)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def report():
+    with _lock:
+        history = list(_history)
+        pending = len(_pending)
+        stats = dict(STATS)
+
+    latencies = [item[1] for item in history]
+    encode_times = [item[2] for item in history]
+
+    throughput = 0.0
+    if len(history) > 1:
+        elapsed = history[-1][0] - (history[0][0] - history[0][1])
+        throughput = sum(item[3] for item in history) / max(elapsed, 1e-6)
+
+    return {
+        **stats,
+        "pending": pending,
+        "images_per_second": throughput,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_max": max(latencies, default=0.0),
+        "encode_mean": sum(encode_times) / len(encode_times) if encode_times else 0.0,
+    }
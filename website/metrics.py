@@ -0,0 +1,163 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# metrics in the Prometheus text format, the website, the worker and the model
+# have the same copy of this module. An update takes a lock and changes a dict,
+# numbers that are already kept elsewhere are read by a function when scraped
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a fast api call to a long generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(
+        self, name, documentation, labels=(), function=None, registry=REGISTRY
+    ):
+        # function returns the value, or {label values: value} with labels,
+        # a single label value may be given without a tuple
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                return list(self.values.items())
+
+        values = self.function()
+        if not self.labels:
+            return [((), values)]
+        return [
+            (tuple(map(str, key if isinstance(key, tuple) else (key,))), value)
+            for key, value in values.items()
+        ]
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def render(self):
+        lines = self.header()
+        for key, value in self.samples():
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, **kwargs
+    ):
+        super().__init__(name, documentation, labels, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        ind = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                # a count per bucket, the last one is +Inf, and the sum
+                self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.values[key]
+            counts[ind] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self.lock:
+            values = [
+                (key, list(counts), total[0])
+                for key, (counts, total) in self.values.items()
+            ]
+
+        lines = self.header()
+        for key, counts, total in values:
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                count += bucket_count
+                labels = format_labels(
+                    self.labels + ("le",), key + (format_value(bound),)
+                )
+                lines.append(f"{self.name}_bucket{labels} {count}")
+
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return "\n".join(lines) + "\n"
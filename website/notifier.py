@@ -0,0 +1,58 @@
+import threading
+
+MAX_TRACKED = 10000
+
+
+class Notifier:
+    def __init__(self, max_tracked: int = MAX_TRACKED):
+        self.condition = threading.Condition()
+        self.values = {}
+        self.max_tracked = max_tracked
+
+    def publish(self, key, value):
+        with self.condition:
+            self.values.pop(key, None)
+            self.values[key] = value
+
+            while len(self.values) > self.max_tracked:
+                self.values.pop(next(iter(self.values)))
+
+            self.condition.notify_all()
+
+    def increment(self, key):
+        with self.condition:
+            self.publish(key, self.values.get(key, 0) + 1)
+
+    def get(self, key, default=None):
+        with self.condition:
+            return self.values.get(key, default)
+
+    def wait(self, key, last_value, timeout: float):
+        # returns the new value, or last_value if nothing changed before timeout
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.values.get(key, last_value) != last_value, timeout
+            )
+            return self.values.get(key, last_value)
+
+    def wait_many(self, last_values, timeout: float):
+        # like wait, for a dict of key -> last value, returns the new values
+        with self.condition:
+            self.condition.wait_for(
+                lambda: any(
+                    self.values.get(key, value) != value
+                    for key, value in last_values.items()
+                ),
+                timeout,
+            )
+            return {
+                key: self.values.get(key, value) for key, value in last_values.items()
+            }
+
+
+# statuses of sessions, published by get_results and send_task, and progress
+# of their previews under ("progress", id), published by send_preview
+STATUSES = Notifier()
+
+# counter of submitted tasks, wakes long polling get_task
+TASKS = Notifier()
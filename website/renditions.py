@@ -0,0 +1,67 @@
+import io
+import os
+
+from PIL import Image, features
+
+# previews shown on the results page, the full PNG is only downloaded
+PREVIEW_SIZE = 384
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+
+# (file suffix, PIL format, save options), the first one is the fallback <img>
+RENDITIONS = [("webp", "WEBP", {"quality": WEBP_QUALITY, "method": 4})]
+
+if features.check("avif"):
+    RENDITIONS.append(("avif", "AVIF", {"quality": AVIF_QUALITY}))
+
+MIMETYPES = {"webp": "image/webp", "avif": "image/avif"}
+
+# low resolution image from the latents, replaced while the job runs
+PROGRESS_NAME = "progress.png"
+
+
+def preview_name(name, suffix):
+    return f"{os.path.splitext(name)[0]}.preview.{suffix}"
+
+
+def preview_names(names):
+    return [preview_name(name, suffix) for name in names for suffix, _, _ in RENDITIONS]
+
+
+def source_name(name):
+    # img_0.preview.webp -> img_0.png
+    return f"{name.split('.', 1)[0]}.png"
+
+
+def is_preview(name):
+    return any(name == preview_name(source_name(name), suffix) for suffix in MIMETYPES)
+
+
+def make_previews(name, data):
+    # returns (preview name, bytes) pairs for the PNG image data
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB")
+    img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+
+    previews = []
+    for suffix, image_format, options in RENDITIONS:
+        buffer = io.BytesIO()
+        img.save(buffer, image_format, **options)
+        previews.append((preview_name(name, suffix), buffer.getvalue()))
+
+    return previews
+
+
+def preview_sources(names, url_for_preview):
+    # <picture> sources for the results page, the browser picks the first it supports
+    return [
+        {
+            "sources": [
+                (url_for_preview(preview_name(name, suffix)), MIMETYPES[suffix])
+                for suffix, _, _ in RENDITIONS[1:]
+            ],
+            "src": url_for_preview(preview_name(name, RENDITIONS[0][0])),
+            "name": name,
+        }
+        for name in names
+    ]
@@ -0,0 +1,155 @@
+import json
+import hashlib
+
+import db
+import storage
+from image_codec import LEGACY_SHAPE
+from renditions import PROGRESS_NAME, preview_names
+
+MAX_ENTRIES = 1000
+MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Images are only reproducible while the model runs with fixed_code and a fixed
+# seed, these values must match model/config.yaml
+GENERATION_SETTINGS = {
+    "ddim_steps": 100,
+    "plms": True,
+    "seed": 42,
+    "fixed_code": True,
+    "H": 256,
+    "W": 256,
+    "n_samples": 3,
+    "scale": 7.5,
+    "ddim_eta": 0.0,
+}
+
+# quality tiers override GENERATION_SETTINGS, best first, these values must
+# match tiers in model/config.yaml
+QUALITY_TIERS = {
+    "full": {"ddim_steps": 100, "H": 256, "W": 256, "n_samples": 3},
+    "fast": {"ddim_steps": 50, "H": 256, "W": 256, "n_samples": 3},
+    "draft": {"ddim_steps": 25, "H": 192, "W": 192, "n_samples": 2},
+}
+
+# the model samples latents of H // f by W // f and the first stage of SD v1
+# upsamples them 8 times, f must match model/config.yaml
+LATENT_FACTOR = 4
+DECODER_FACTOR = 8
+
+STATS = {"hits": 0, "misses": 0, "coalesced": 0, "evicted": 0}
+
+
+def normalize_prompt(text):
+    # CLIP tokenizer lowercases text and collapses whitespace anyway
+    return " ".join(text.split()).lower()
+
+
+def cache_key(text, settings=None):
+    key_data = {
+        "prompt": normalize_prompt(text),
+        "settings": settings if settings is not None else GENERATION_SETTINGS,
+    }
+    key_json = json.dumps(key_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+
+def generation_settings(tier):
+    return {**GENERATION_SETTINGS, **QUALITY_TIERS[tier]}
+
+
+def cache_keys(text, tier):
+    # (tier, key) pairs of the tier and the better ones, best first, results
+    # of a better tier are good enough
+    tiers = list(QUALITY_TIERS)
+    return [
+        (name, cache_key(text, generation_settings(name)))
+        for name in tiers[: tiers.index(tier) + 1]
+    ]
+
+
+def image_shape(params):
+    # images in the list format carry no shape, it follows the request settings
+    if not params or "H" not in params or "W" not in params:
+        return LEGACY_SHAPE
+    return (
+        params["H"] // LATENT_FACTOR * DECODER_FACTOR,
+        params["W"] // LATENT_FACTOR * DECODER_FACTOR,
+        3,
+    )
+
+
+def image_names(n_images):
+    return [f"img_{ind}.png" for ind in range(n_images)]
+
+
+def result_files(names):
+    return names + preview_names(names)
+
+
+def clear_results(user_id):
+    # results are replaced, never overwritten in place: local files may be
+    # hard links to the result cache
+    user_data = storage.user_data()
+    names = [
+        name
+        for name in user_data.list(user_id)
+        if name.startswith("img_") or name == PROGRESS_NAME
+    ]
+    user_data.remove(user_id, names)
+
+
+def lookup(key, user_id):
+    data = db.get_cache_entry(key)
+
+    if data is None:
+        STATS["misses"] += 1
+        return None
+
+    cache = storage.result_cache()
+    names = image_names(data["n_images"])
+    files = result_files(names)
+    if not set(files) <= cache.list(key).keys():
+        db.delete_cache_entry(key)
+        STATS["misses"] += 1
+        return None
+
+    storage.user_data().copy(cache, key, user_id, files)
+
+    db.touch_cache_entry(key)
+    STATS["hits"] += 1
+    return names
+
+
+def store(key, user_id, n_images):
+    cache = storage.result_cache()
+    files = result_files(image_names(n_images))
+    cache.copy(storage.user_data(), user_id, key, files)
+
+    sizes = cache.list(key)
+    db.save_cache_entry(key, n_images, sum(sizes.get(name, 0) for name in files))
+
+    evict()
+
+
+def evict():
+    entries, size = db.get_cache_totals()
+
+    if entries <= MAX_ENTRIES and size <= MAX_BYTES:
+        return
+
+    cache = storage.result_cache()
+    for item in db.get_cache_lru():
+        if entries <= MAX_ENTRIES and size <= MAX_BYTES:
+            break
+
+        db.delete_cache_entry(item["key"])
+        cache.remove(item["key"])
+
+        entries -= 1
+        size -= item["size"]
+        STATS["evicted"] += 1
+
+
+def hit_rate():
+    lookups = STATS["hits"] + STATS["misses"]
+    return STATS["hits"] / lookups if lookups else 0.0
@@ -0,0 +1,127 @@
+import time
+import threading
+from datetime import datetime as dt, timedelta
+
+import db
+
+# requests are served in submission order, a priority class only moves a
+# request HEAD_START_SECONDS ahead, so older requests still age past it
+HEAD_START_SECONDS = {"default": 0, "api": 300}
+
+# API clients send a key in the X-API-Key header, key -> priority class
+API_KEYS = {}
+
+# throughput and job duration are measured over the recent window and
+# cached, they are shown to every waiting user
+THROUGHPUT_WINDOW_SECONDS = 15 * 60
+THROUGHPUT_CACHE_SECONDS = 10
+# after a restart or a quiet period the arrival rate is counted from the first
+# arrival, but over no less than this
+MIN_THROUGHPUT_WINDOW_SECONDS = 60
+
+# the quality tier of a new job follows the backlog, the first tier whose
+# queue length is reached is used
+TIER_QUEUE_LENGTHS = [("draft", 100), ("fast", 30), ("full", 0)]
+
+_lock = threading.Lock()
+_throughput = {
+    "updated": None,
+    "jobs_per_second": 0.0,
+    "arrivals_per_second": 0.0,
+    "service_time": None,
+}
+
+
+def priority_class(api_key):
+    return API_KEYS.get(api_key, "default") if api_key else "default"
+
+
+def sched_key(priority="default"):
+    return time.time() - HEAD_START_SECONDS.get(priority, 0)
+
+
+def pick_tier():
+    queue_length = db.get_queue_length()
+    for tier, min_length in TIER_QUEUE_LENGTHS:
+        if queue_length >= min_length:
+            return tier
+    return TIER_QUEUE_LENGTHS[-1][0]
+
+
+def timestamp(value):
+    return dt.fromisoformat(value).timestamp()
+
+
+def busy_seconds(intervals):
+    # time with at least one job running, jobs of one batch or of parallel
+    # workers overlap and are counted once
+    busy = 0.0
+    end = None
+    for started, finished in sorted(intervals):
+        if end is None or started > end:
+            busy += finished - started
+            end = finished
+        elif finished > end:
+            busy += finished - end
+            end = finished
+    return busy
+
+
+def get_throughput():
+    # jobs_per_second is the capacity of the workers: jobs done per second of
+    # busy time, a quiet hour doesn't make them look slow. arrivals_per_second
+    # is the demand
+    with _lock:
+        updated = _throughput["updated"]
+        fresh = time.monotonic() - (updated or 0) < THROUGHPUT_CACHE_SECONDS
+        if updated is not None and fresh:
+            return dict(_throughput)
+
+    now = dt.now()
+    since = now - timedelta(seconds=THROUGHPUT_WINDOW_SECONDS)
+    intervals = [
+        (timestamp(job["started"]), timestamp(job["finished"]))
+        for job in db.get_recent_jobs(since)
+    ]
+    busy = busy_seconds(intervals)
+    durations = [finished - started for started, finished in intervals]
+    arrivals = db.get_arrivals(since)
+
+    window = THROUGHPUT_WINDOW_SECONDS
+    if arrivals["first"] is not None:
+        elapsed = (now - dt.fromisoformat(arrivals["first"])).total_seconds()
+        window = min(max(elapsed, MIN_THROUGHPUT_WINDOW_SECONDS), window)
+
+    with _lock:
+        _throughput["updated"] = time.monotonic()
+        _throughput["jobs_per_second"] = len(intervals) / busy if busy > 0 else 0.0
+        _throughput["arrivals_per_second"] = arrivals["arrivals"] / window
+        _throughput["service_time"] = (
+            sum(durations) / len(durations) if durations else None
+        )
+        return dict(_throughput)
+
+
+def estimate_wait(jobs_ahead):
+    # seconds until a job with jobs_ahead queued before it is done, None until
+    # the workers' capacity is measured
+    throughput = get_throughput()
+    if throughput["service_time"] is None or throughput["jobs_per_second"] <= 0:
+        return None
+    return jobs_ahead / throughput["jobs_per_second"] + throughput["service_time"]
+
+
+def queue_info(data):
+    # position in the queue and seconds until the results, None if unknown
+    if data is None or data["stat"] not in (db.STAT_QUEUED, db.STAT_RUNNING):
+        return {"position": None, "eta": None}
+
+    if data["stat"] == db.STAT_RUNNING:
+        service_time = get_throughput()["service_time"]
+        if service_time is None or data["started"] is None:
+            return {"position": 0, "eta": None}
+        elapsed = (dt.now() - dt.fromisoformat(data["started"])).total_seconds()
+        return {"position": 0, "eta": max(service_time - elapsed, 0)}
+
+    position = db.get_queue_position(data["sched_key"]) if data["sched_key"] else 0
+    return {"position": position, "eta": estimate_wait(position)}
@@ -1,79 +1,222 @@
-import os
-import sqlite3
-import zipfile
+import json
+import time
+import logging
+import base64
+import hashlib
 from datetime import datetime as dt
+from functools import partial, wraps
 from secrets import token_hex
 
-import numpy as np
 from flask import (
     Flask,
+    Response,
+    abort,
     redirect,
     render_template,
     request,
     send_from_directory,
     session,
+    stream_with_context,
     url_for,
 )
-from PIL import Image
+
+import admission
+import db
+import ingest
+import storage
+from compression import decompress_body
+from image_codec import SUPPORTED_FORMATS, validate_image
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from notifier import STATUSES, TASKS
+from renditions import PROGRESS_NAME, is_preview, preview_sources, source_name
+from result_cache import (
+    STATS,
+    cache_keys,
+    clear_results,
+    generation_settings,
+    hit_rate,
+    image_shape,
+    lookup,
+)
+from scheduler import pick_tier, priority_class, queue_info, sched_key
+from static_assets import (
+    ASSETS,
+    FINGERPRINT_LENGTH,
+    IMMUTABLE_MAX_AGE,
+    PAGES,
+    add_page,
+    choose_encoding,
+    fingerprint,
+    load_assets,
+)
+from zip_stream import make_entry, stream_zip, zip_size
 
 app = Flask(__name__)
 app.secret_key = b"1234567890qwertyuiopasdfghjklzxcvbnm"
 
+logger = logging.getLogger(__name__)
+
 TOKEN = "mytoken"
 
+# server-sent events: heartbeat period, every heartbeat re-checks the status in
+# the database for updates made by other server processes, it's no longer than
+# the polling period of the page, and stream lifetime
+EVENTS_HEARTBEAT_SECONDS = 10
+EVENTS_STREAM_SECONDS = 600
+
+# long polling of get_task: the longest wait a worker may ask for and
+# the database re-check period (for tasks submitted to other processes)
+MAX_TASK_WAIT_SECONDS = 30
+TASK_DB_CHECK_SECONDS = 5
+
+# session images are private, versioned urls are cached for a day
+RESULT_MAX_AGE = 24 * 3600
+
+# progressive previews are tiny PNG images
+MAX_PROGRESS_IMAGE_BYTES = 256 * 1024
+
+STAT_NAMES = {
+    db.STAT_QUEUED: "queued",
+    db.STAT_RUNNING: "running",
+    db.STAT_DONE: "done",
+    db.STAT_ERROR: "error",
+    db.STAT_EXPIRED: "expired",
+}
+
+GET_TASK_SECONDS = Histogram(
+    "website_get_task_seconds", "get_task latency, long polls included", ["status"]
+)
+SEND_TASK_SECONDS = Histogram(
+    "website_send_task_seconds", "send_task latency", ["status"]
+)
 
-def get_db_connection():
-    conn = sqlite3.connect("database/database.db")
-    conn.row_factory = sqlite3.Row
-    return conn
 
+def queue_depth():
+    counts = db.get_status_counts()
+    return {name: counts.get(stat, 0) for stat, name in STAT_NAMES.items()}
 
-def create_zip():
-    if "username" not in session:
-        session["username"] = token_hex(8)
 
-    user_id = session["username"]
+# these are counted anyway, they are read only when scraped
+Gauge("website_queue_depth", "Requests by state", ["stat"], function=queue_depth)
+Counter(
+    "website_admission_total",
+    "New prompts answered with Retry-After, by reason",
+    ["reason"],
+    function=lambda: admission.STATS,
+)
+Counter(
+    "website_ingest_total",
+    "Results by ingest event, rejected ones are retried by the worker",
+    ["event"],
+    function=lambda: ingest.STATS,
+)
+Counter(
+    "website_result_cache_total",
+    "Result cache lookups by outcome",
+    ["event"],
+    function=lambda: STATS,
+)
+
 
-    if os.path.exists(f"user_data/{user_id}/images.zip"):
-        return
+def timed(histogram):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            response = app.make_response(view(*args, **kwargs))
+            elapsed = time.perf_counter() - started
+            histogram.observe(elapsed, status=response.status_code)
+            return response
 
-    file_names = []
+        return wrapper
 
-    for ind in range(3):
-        if not os.path.exists(f"user_data/{user_id}/img_{ind}.png"):
-            raise RuntimeError("No files")
+    return decorator
+
+
+def get_request_json():
+    # worker may compress large bodies with gzip or zstd
+    encoding = request.headers.get("Content-Encoding", "identity")
+    if encoding == "identity":
+        return request.get_json(silent=True)
+
+    try:
+        return json.loads(decompress_body(request.get_data(), encoding))
+    except ValueError:
+        return None
 
-        file_names.append(f"user_data/{user_id}/img_{ind}.png")
 
-    if not os.path.exists(f"user_data/{user_id}/text.txt"):
-        raise RuntimeError("No files")
+def create_zip_entries(data):
+    user_id = data["id"]
+    user_data = storage.user_data()
+    timestamp = finished_time(data).timestamp() if data["finished"] else None
 
-    file_names.append(f"user_data/{user_id}/text.txt")
+    names = db.get_images(data)
+    if not set(names) <= user_data.list(user_id).keys():
+        return None
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM requests WHERE id = ? AND stat=3 LIMIT 1",
-        (session["username"],),
+    entries = [
+        make_entry(
+            name,
+            open_chunks=partial(user_data.chunks, user_id, name),
+            timestamp=timestamp,
+        )
+        for name in names
+    ]
+    entries.append(
+        make_entry("text.txt", data=data["prompt"].encode("utf-8"), timestamp=timestamp)
     )
-    data = cur.fetchone()
-    conn.close()
 
-    if not data:
-        raise RuntimeError("Invalid status")
+    return entries
 
-    zip_file = zipfile.ZipFile(f"user_data/{user_id}/images.zip", mode="w")
 
-    try:
-        for file_name in file_names:
-            zip_file.write(file_name, os.path.basename(file_name))
+def asset_response(asset, immutable):
+    encoding = choose_encoding(asset, request.accept_encodings)
+
+    response = Response(asset["variants"][encoding], mimetype=asset["mimetype"])
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(f"{asset['hash']}-{encoding}")
+
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def static_file(filename):
+    asset = ASSETS.get(filename)
+    immutable = asset is not None and request.args.get("v") == asset["hash"]
+
+    if asset is None or asset["variants"] is None:
+        response = send_from_directory(
+            app.static_folder,
+            filename,
+            max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        )
+        if immutable:
+            response.cache_control.immutable = True
+        return response
 
-        zip_file.close()
+    return asset_response(asset, immutable).make_conditional(request)
 
-    except:
-        zip_file.close()
-        if os.path.exists(f"user_data/{user_id}/images.zip"):
-            os.remove(f"user_data/{user_id}/images.zip")
+
+def error_page(name, status):
+    # pages without dynamic content are rendered and compressed at startup
+    if name not in PAGES:
+        return render_template(name), status
+    return asset_response(PAGES[name], immutable=False), status
+
+
+@app.url_defaults
+def static_fingerprint(endpoint, values):
+    if endpoint == "static" and "v" not in values:
+        version = fingerprint(values.get("filename"))
+        if version is not None:
+            values["v"] = version
 
 
 @app.route("/", methods=["GET"])
@@ -83,12 +226,12 @@ def start_page():
 
 @app.errorhandler(500)
 def server_error(error):
-    return render_template("500_error.html"), 500
+    return error_page("500_error.html", 500)
 
 
 @app.errorhandler(404)
 def server_error(error):
-    return render_template("404_error.html"), 404
+    return error_page("404_error.html", 404)
 
 
 @app.route("/get_results", methods=["GET"])
@@ -101,87 +244,155 @@ def get_results():
     # submit task if possible
     if text:
         assert len(text) <= 100
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT stat FROM requests WHERE id = ? LIMIT 1",
-            (session["username"],),
-        )
-        data = cur.fetchone()
-        if data is None or (data["stat"] != 1 and data["stat"] != 2):
-            os.makedirs(f"user_data/{session['username']}", exist_ok=True)
-            with open(
-                f"user_data/{session['username']}/text.txt", "w", encoding="utf-8"
-            ) as fp:
-                fp.write(text)
-
-            if data is None:
-                cur.execute(
-                    "INSERT INTO requests (id, stat, edited) VALUES (?, ?, ?)",
-                    (session["username"], 1, dt.now()),
-                )
-            else:
-                cur.execute(
-                    "UPDATE requests SET stat=1, edited=? WHERE id=?",
-                    (dt.now(), session["username"]),
+        stat = db.get_status(session["username"])
+        if stat in (db.STAT_QUEUED, db.STAT_RUNNING):
+            return render_template("too_many_queries.html")
+
+        # results of the picked tier or a better one are served from the cache
+        # or joined while running
+        keys = cache_keys(text, pick_tier())
+        tier, key = keys[-1]
+        for tier_name, tier_key in keys:
+            if db.get_cache_entry(tier_key) is not None or db.is_running(tier_key):
+                tier, key = tier_name, tier_key
+                break
+
+        # prompts served by the cache or a running job don't add work
+        if db.get_cache_entry(key) is None and not db.is_running(key):
+            retry_after = admission.admit(request.remote_addr, session["username"])
+            if retry_after:
+                return (
+                    render_template("too_many_queries.html", RETRY_AFTER=retry_after),
+                    429,
+                    {"Retry-After": str(retry_after)},
                 )
-            conn.commit()
-            conn.close()
 
-            return redirect("/get_results")
+        clear_results(session["username"])
+
+        images = lookup(key, session["username"])
+        if images is not None:
+            stat = db.STAT_DONE
+        elif db.is_running(key):
+            # attach to the job with the same prompt if it's already running
+            STATS["coalesced"] += 1
+            stat = db.STAT_RUNNING
         else:
-            conn.close()
-            return render_template("too_many_queries.html")
+            stat = db.STAT_QUEUED
+
+        priority = priority_class(request.headers.get("X-API-Key"))
+        db.save_request(
+            session["username"],
+            stat,
+            key,
+            text,
+            {**generation_settings(tier), "tier": tier},
+            sched_key(priority),
+            images,
+        )
 
-    # return images if exists
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM requests WHERE id = ? LIMIT 1",
-        (session["username"],),
-    )
+        STATUSES.publish(session["username"], stat)
+        if stat == db.STAT_QUEUED:
+            TASKS.increment("submitted")
 
-    cur.execute(
-        "SELECT * FROM requests WHERE id = ? AND stat=3 LIMIT 1",
-        (session["username"],),
-    )
-    data = cur.fetchone()
+        return redirect("/get_results")
 
-    flag = True
-    if data is not None:
-        for ind in range(3):
-            if not os.path.isfile(f"user_data/{session['username']}/img_{ind}.png"):
-                flag = False
-                break
-        if not os.path.isfile(f"user_data/{session['username']}/text.txt"):
-            flag = False
-    else:
-        flag = False
-
-    if flag:
-        with open(f"user_data/{session['username']}/text.txt", "r") as fp:
-            text = fp.read()
+    # return images if exists
+    data = db.get_request(session["username"], db.STAT_DONE)
 
+    if data is not None:
+        version = result_version(data)
         return render_template(
             "results.html",
-            QUERY=text,
-            IMAGE_1=url_for("download_image", filepath="img_0.png"),
-            IMAGE_2=url_for("download_image", filepath="img_1.png"),
-            IMAGE_3=url_for("download_image", filepath="img_2.png"),
+            QUERY=data["prompt"],
+            VERSION=version,
+            IMAGES=preview_sources(
+                db.get_images(data),
+                lambda name: url_for("preview_image", filepath=name, v=version),
+            ),
         )
 
-    conn.close()
-
     return render_template("loading_results.html")
 
 
+def result_version(data):
+    # the same prompt and settings always give the same files
+    if data["cache_key"] is not None:
+        return data["cache_key"][:FINGERPRINT_LENGTH]
+    return hashlib.sha256(str(data["finished"]).encode()).hexdigest()[
+        :FINGERPRINT_LENGTH
+    ]
+
+
+def finished_time(data):
+    return dt.fromisoformat(data["finished"]) if data["finished"] else None
+
+
+def set_result_cache_control(response, data):
+    response.cache_control.private = True
+    if request.args.get("v") == result_version(data):
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = RESULT_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+
+def send_result_file(data, filepath, **kwargs):
+    # images never change after stat=3, new results of the session get a new ?v=
+    response = storage.user_data().send(
+        data["id"],
+        filepath,
+        etag=f"{result_version(data)}-{filepath}",
+        last_modified=finished_time(data),
+        **kwargs,
+    )
+    set_result_cache_control(response, data)
+    return response
+
+
 @app.route("/images/<path:filepath>", methods=["GET"])
 def download_image(filepath):
     if "username" not in session:
         session["username"] = token_hex(8)
-    return send_from_directory(
-        f"user_data/{session['username']}", filepath, as_attachment=True
-    )
+
+    data = db.get_request(session["username"], db.STAT_DONE)
+    if data is None:
+        abort(404)
+
+    return send_result_file(data, filepath, as_attachment=True)
+
+
+@app.route("/previews/<path:filepath>", methods=["GET"])
+def preview_image(filepath):
+    if "username" not in session:
+        session["username"] = token_hex(8)
+
+    if not is_preview(filepath):
+        abort(404)
+
+    data = db.get_request(session["username"], db.STAT_DONE)
+    if data is None:
+        abort(404)
+
+    # sessions finished before previews were made show the full image
+    if not storage.user_data().exists(session["username"], filepath):
+        filepath = source_name(filepath)
+
+    return send_result_file(data, filepath)
+
+
+@app.route("/progress", methods=["GET"])
+def progress_image():
+    if "username" not in session:
+        session["username"] = token_hex(8)
+
+    data = db.get_request(session["username"], db.STAT_RUNNING)
+    if data is None or data["progress"] is None:
+        abort(404)
+
+    response = storage.user_data().send(session["username"], PROGRESS_NAME)
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/get_images", methods=["GET"])
@@ -189,16 +400,56 @@ def download_images_zip():
     if "username" not in session:
         session["username"] = token_hex(8)
 
-    create_zip()
-
-    return send_from_directory(
-        f"user_data/{session['username']}", "images.zip", as_attachment=True
+    data = db.get_request(session["username"], db.STAT_DONE)
+    if data is None:
+        abort(404)
+
+    entries = create_zip_entries(data)
+    if entries is None:
+        abort(404)
+
+    # the archive is generated while it's sent, nothing is written to disk
+    response = Response(
+        stream_zip(entries),
+        mimetype="application/zip",
+        headers={
+            "Content-Length": str(zip_size(entries)),
+            "Content-Disposition": "attachment; filename=images.zip",
+        },
     )
+    response.set_etag(f"{result_version(data)}-zip")
+    response.last_modified = finished_time(data)
+    set_result_cache_control(response, data)
+    return response.make_conditional(request)
+
+
+def claim_tasks(worker_id):
+    output_data = []
+
+    # take the write lock before reading, so concurrent workers can't pick
+    # the same rows between SELECT and UPDATE
+    with db.transaction():
+        for item in db.get_queued(limit=3):
+            user_id = item["id"]
+            if not db.claim_request(user_id, worker_id):
+                continue
+
+            STATS["coalesced"] += db.claim_followers(user_id, worker_id)
+
+            # requests saved before quality tiers get the model defaults
+            params = json.loads(item["params"]) if item["params"] else {}
+            task = {"id": user_id, "text": item["prompt"]}
+            if "tier" in params:
+                task["tier"] = params["tier"]
+            output_data.append(task)
+
+    return output_data
 
 
 @app.route("/api/v1/get_task", methods=["POST"])
+@timed(GET_TASK_SECONDS)
 def get_task():
-    content = request.json
+    content = get_request_json()
 
     if content is None:
         return {"error": "No data"}, 400
@@ -209,39 +460,83 @@ def get_task():
     if content["token"] != TOKEN:
         return {"error": "No valid authentication credentials"}, 401
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    try:
+        wait = min(float(content.get("wait", 0)), MAX_TASK_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        return {"error": "Invalid wait"}, 400
 
-    cur.execute("SELECT id FROM requests WHERE stat = 1 LIMIT 3")
-    data = cur.fetchall()
+    worker_id = str(content.get("worker_id", request.remote_addr))[:64]
 
-    ids = [item["id"] for item in data]
+    deadline = time.monotonic() + wait
 
-    output_data = []
-    for user_id in ids:
-        if os.path.isfile(f"user_data/{user_id}/text.txt"):
-            with open(f"user_data/{user_id}/text.txt", "r", encoding="utf-8") as fp:
-                text = fp.read()
-            output_data.append({"id": user_id, "text": text})
+    submitted = TASKS.get("submitted", 0)
+    output_data = claim_tasks(worker_id)
+
+    # long polling: hold the request until a task is submitted or time is out
+    while not output_data and time.monotonic() < deadline:
+        timeout = min(deadline - time.monotonic(), TASK_DB_CHECK_SECONDS)
+        submitted = TASKS.wait("submitted", submitted, max(timeout, 0))
+        output_data = claim_tasks(worker_id)
 
     if not output_data:
-        conn.close()
-        return {"result": 0}
+        if wait > 0:
+            return {"result": 0, "long_poll": True}
+        return {"result": 0, "retry_after_seconds": admission.task_retry_after()}
 
-    for item in output_data:
-        cur.execute(
-            "UPDATE requests SET stat=2, edited=? WHERE id=?", (dt.now(), item["id"])
-        )
+    return {
+        "result": len(output_data),
+        "data": output_data,
+        "formats": list(SUPPORTED_FORMATS),
+    }
+
+
+@app.route("/api/v1/preview", methods=["POST"])
+def send_preview():
+    content = get_request_json()
+
+    if content is None:
+        return {"error": "No data"}, 400
+
+    if "token" not in content:
+        return {"error": "Not authorized"}, 401
+
+    if content["token"] != TOKEN:
+        return {"error": "No valid authentication credentials"}, 401
+
+    try:
+        user_id = str(content["id"])
+        progress = min(100 * int(content["step"]) // int(content["steps"]), 100)
+        if content["image"]["format"] != "png":
+            raise ValueError("Previews must be PNG images")
+        validate_image(content["image"], shape=None)
+        image = base64.b64decode(content["image"]["data"])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return {"error": "Invalid preview"}, 400
+
+    if len(image) > MAX_PROGRESS_IMAGE_BYTES:
+        return {"error": "Preview is too large"}, 413
+
+    data = db.get_request(user_id, db.STAT_RUNNING)
+    if data is None:
+        return {}, 204
 
-    conn.commit()
-    conn.close()
+    # users waiting for the same prompt see the same preview
+    user_ids = [user_id] + db.get_followers(data["cache_key"], user_id)
+    user_data = storage.user_data()
+    for follower_id in user_ids:
+        user_data.save(follower_id, PROGRESS_NAME, image)
+    db.set_progress(user_ids, progress)
 
-    return {"result": len(output_data), "data": output_data}
+    for follower_id in user_ids:
+        STATUSES.publish(("progress", follower_id), progress)
+
+    return {}, 202
 
 
 @app.route("/api/v1/send_task", methods=["POST"])
+@timed(SEND_TASK_SECONDS)
 def send_task():
-    content = request.json
+    content = get_request_json()
 
     if content is None:
         return {"error": "No data"}, 400
@@ -255,56 +550,88 @@ def send_task():
     if content["result"] == 0:
         return {}, 201
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
+    # check everything before acknowledging, images are written in the background
     error_users = []
-    update_users = []
+    results = []
     for item in content["data"]:
         user_id = item["id"]
-        if not os.path.isdir(f"user_data/{user_id}"):
-            continue
 
-        cur.execute("SELECT * FROM requests WHERE id=? AND stat=2 LIMIT 1", (user_id,))
-        data = cur.fetchone()
+        data = db.get_request(user_id, db.STAT_RUNNING)
 
-        if not data:
+        if not data or ingest.is_pending(user_id):
             continue
 
-        if "error" in item:
-            error_users.append(user_id)
-            continue
+        if "error" not in item:
+            params = json.loads(data["params"]) if data["params"] else {}
+            shape = image_shape(params)
+            try:
+                images = [
+                    item["images"][str(ind)] for ind in range(len(item["images"]))
+                ]
+                for image in images:
+                    validate_image(image, shape)
+            except (KeyError, TypeError, ValueError) as e:
+                # the same images would come again on a retry, the job fails
+                logger.warning("Invalid images of %s: %s", user_id, e)
+            else:
+                results.append((user_id, images, shape))
+                continue
 
-        images = item["images"]
+        error_users.append(user_id)
+        if data["cache_key"] is not None:
+            error_users += db.get_followers(data["cache_key"], user_id)
 
-        images = [
-            np.array(images[str(ind)], dtype=np.uint8) for ind in range(len(images))
-        ]
-        images = [img.reshape((512, 512, 3)) for img in images]
-        images = [Image.fromarray(img) for img in images]
+    if error_users:
+        with db.transaction():
+            db.set_status(error_users, db.STAT_ERROR)
 
-        for ind, img in enumerate(images):
-            img.save(f"user_data/{user_id}/img_{ind}.png")
+        for user_id in error_users:
+            STATUSES.publish(user_id, db.STAT_ERROR)
 
-        if os.path.exists(f"user_data/{user_id}/images.zip"):
-            os.remove(f"user_data/{user_id}/images.zip")
+    for user_id, images, shape in results:
+        if not ingest.submit(user_id, images, shape):
+            if ingest.is_pending(user_id):
+                continue
+            return (
+                {"error": "Too many results are being saved"},
+                503,
+                {"Retry-After": str(ingest.QUEUE_TIMEOUT_SECONDS)},
+            )
 
-        update_users.append(user_id)
+    return {"accepted": len(results), "failed": len(error_users)}, 202
 
-    for user_id in update_users:
-        cur.execute(
-            "UPDATE requests SET stat=3, edited=? WHERE id=?", (dt.now(), user_id)
-        )
 
-    for user_id in error_users:
-        cur.execute(
-            "UPDATE requests SET stat=4, edited=? WHERE id=?", (dt.now(), user_id)
-        )
+@app.route("/api/v1/ingest_stats", methods=["POST"])
+def ingest_stats():
+    content = get_request_json()
+
+    if content is None:
+        return {"error": "No data"}, 400
 
-    conn.commit()
-    conn.close()
+    if content.get("token") != TOKEN:
+        return {"error": "No valid authentication credentials"}, 401
+
+    return {**ingest.report(), "result_cache": {**STATS, "hit_rate": hit_rate()}}
 
-    return {}, 201
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Prometheus sends the token with authorization: {credentials: ...}
+    if request.headers.get("Authorization") != f"Bearer {TOKEN}":
+        return {"error": "No valid authentication credentials"}, 401
+
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+def progress_info(data):
+    # share of sampling steps done and the low resolution image of the job
+    if data is None or data["stat"] != db.STAT_RUNNING or data["progress"] is None:
+        return {"progress": None, "preview": None}
+
+    return {
+        "progress": data["progress"],
+        "preview": url_for("progress_image", v=data["progress"]),
+    }
 
 
 @app.route("/api/v1/ready", methods=["GET"])
@@ -312,21 +639,65 @@ def ready_user():
     if "username" not in session:
         session["username"] = token_hex(8)
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT stat FROM requests WHERE id = ? LIMIT 1",
-        (session["username"],),
-    )
-    data = cur.fetchone()
+    data = db.get_request(session["username"])
+    status = data["stat"] if data is not None else 0
 
-    conn.close()
+    return {"status": status, **queue_info(data), **progress_info(data)}
 
-    if data is not None:
-        return {"status": data["stat"]}
 
-    else:
-        return {"status": 0}
+@app.route("/api/v1/events", methods=["GET"])
+def status_events():
+    if "username" not in session:
+        session["username"] = token_hex(8)
+
+    user_id = session["username"]
+
+    def queue_event(data):
+        # heartbeats carry the queue position and ETA while the request waits
+        info = {**queue_info(data), **progress_info(data)}
+        return f"event: queue\ndata: {json.dumps(info)}\n\n"
+
+    def status_event(status):
+        return f"event: status\ndata: {json.dumps({'status': status})}\n\n"
+
+    def stream():
+        data = db.get_request(user_id)
+        status = data["stat"] if data is not None else 0
+        yield "retry: 3000\n" + status_event(status)
+        if status in (db.STAT_QUEUED, db.STAT_RUNNING):
+            yield queue_event(data)
+
+        progress_key = ("progress", user_id)
+        notified = STATUSES.get(user_id, status)
+        progress = STATUSES.get(progress_key)
+        started = time.monotonic()
+        while status in (db.STAT_QUEUED, db.STAT_RUNNING):
+            if time.monotonic() - started > EVENTS_STREAM_SECONDS:
+                # browser reconnects by itself
+                return
+
+            values = STATUSES.wait_many(
+                {user_id: notified, progress_key: progress}, EVENTS_HEARTBEAT_SECONDS
+            )
+            notified, progress = values[user_id], values[progress_key]
+
+            # the database is the source of truth, notifications only wake us up,
+            # the heartbeat notices updates made by other server processes
+            data = db.get_request(user_id)
+            new_status = data["stat"] if data is not None else 0
+            if new_status == status:
+                yield queue_event(data)
+                continue
+
+            status = new_status
+            yield status_event(status)
+
+    # queue events build preview urls, they need the request context
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/error_500", methods=["GET"])
@@ -334,5 +705,13 @@ def check_500():
     return render_template("500_error.html")
 
 
+app.view_functions["static"] = static_file
+
+load_assets(app.static_folder)
+with app.test_request_context():
+    for name in ("404_error.html", "500_error.html"):
+        add_page(name, render_template(name))
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0")
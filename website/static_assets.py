@@ -0,0 +1,68 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# text files are compressed once at startup and kept in memory
+COMPRESSED_EXTENSIONS = (".css", ".js", ".map", ".html", ".svg")
+
+# fingerprinted urls (?v=<hash>) never change, the rest is revalidated
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+FINGERPRINT_LENGTH = 12
+
+ASSETS = {}
+PAGES = {}
+
+
+def compress_variants(data):
+    variants = {"identity": data, "gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return variants
+
+
+def load_assets(static_dir):
+    for root, _, files in os.walk(static_dir):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            name = os.path.relpath(path, static_dir).replace(os.sep, "/")
+
+            with open(path, "rb") as fp:
+                data = fp.read()
+
+            asset = {
+                "hash": hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH],
+                "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                "variants": None,
+            }
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                asset["variants"] = compress_variants(data)
+
+            ASSETS[name] = asset
+
+
+def add_page(name, html):
+    data = html.encode("utf-8")
+    PAGES[name] = {
+        "hash": hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH],
+        "mimetype": "text/html",
+        "variants": compress_variants(data),
+    }
+
+
+def fingerprint(name):
+    asset = ASSETS.get(name)
+    return asset["hash"] if asset is not None else None
+
+
+def choose_encoding(asset, accept_encodings):
+    for encoding in ("br", "gzip"):
+        if encoding in asset["variants"] and accept_encodings[encoding]:
+            return encoding
+    return "identity"
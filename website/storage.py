@@ -0,0 +1,321 @@
+import io
+import os
+import re
+import shutil
+import hashlib
+import mimetypes
+
+from flask import send_file, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# "local" keeps files on disk (may be a shared mount), "s3" in a bucket that
+# several website nodes can share
+BACKEND = "local"
+
+# local: <ROOT_DIR>/<area>/<ab>/<cd>/<group>/<name>, a directory per group
+# and SHARD_LEVELS levels of hash prefixes keep directories small
+ROOT_DIR = "."
+SHARD_LEVELS = 2
+
+# s3: <S3_PREFIX><area>/<group>/<name>, endpoint url is for MinIO and others
+S3_BUCKET = "image-generator"
+S3_PREFIX = ""
+S3_ENDPOINT_URL = None
+
+CHUNK_SIZE = 64 * 1024
+
+USER_DATA = "user_data"
+RESULT_CACHE = "result_cache"
+
+# session ids, cache keys and file names, nothing that can escape the root
+VALID_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$")
+
+_storages = {}
+
+
+def configure(backend=None, root_dir=None):
+    global BACKEND, ROOT_DIR
+    if backend is not None:
+        BACKEND = backend
+    if root_dir is not None:
+        ROOT_DIR = root_dir
+
+
+def get_storage(area):
+    if BACKEND == "s3":
+        key = (BACKEND, S3_BUCKET, S3_PREFIX, area)
+        if key not in _storages:
+            _storages[key] = S3Storage(
+                S3_BUCKET, f"{S3_PREFIX}{area}/", S3_ENDPOINT_URL
+            )
+        return _storages[key]
+
+    # relative to the current directory at the time of the call, like db paths
+    root = os.path.abspath(os.path.join(ROOT_DIR, area))
+    key = (BACKEND, root)
+    if key not in _storages:
+        _storages[key] = LocalStorage(root)
+    return _storages[key]
+
+
+def user_data():
+    return get_storage(USER_DATA)
+
+
+def result_cache():
+    return get_storage(RESULT_CACHE)
+
+
+def check_name(name):
+    if not VALID_NAME.match(name):
+        raise ValueError(f"Invalid storage name '{name}'")
+
+
+class LocalStorage:
+    def __init__(self, root, shard_levels=SHARD_LEVELS):
+        self.root = root
+        self.shard_levels = shard_levels
+
+    def group_dir(self, group):
+        check_name(group)
+        digest = hashlib.sha1(group.encode("utf-8")).hexdigest()
+        shards = [digest[2 * ind : 2 * ind + 2] for ind in range(self.shard_levels)]
+        return os.path.join(self.root, *shards, group)
+
+    def path(self, group, name):
+        check_name(name)
+        return os.path.join(self.group_dir(group), name)
+
+    def save(self, group, name, data):
+        # the file is complete on disk when save returns, see sync for the directory
+        path = self.path(group, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(f"{path}.tmp", "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def sync(self, group):
+        fd = os.open(self.group_dir(group), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self, group, name):
+        with open(self.path(group, name), "rb") as fp:
+            return fp.read()
+
+    def chunks(self, group, name):
+        with open(self.path(group, name), "rb") as fp:
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def exists(self, group, name):
+        return os.path.isfile(self.path(group, name))
+
+    def mtime(self, group, name):
+        return os.path.getmtime(self.path(group, name))
+
+    def list(self, group):
+        # name -> size
+        try:
+            with os.scandir(self.group_dir(group)) as entries:
+                return {
+                    entry.name: entry.stat().st_size
+                    for entry in entries
+                    if entry.is_file() and not entry.name.endswith(".tmp")
+                }
+        except FileNotFoundError:
+            return {}
+
+    def copy(self, source, src_group, dst_group, names):
+        # hard links when both are on the same file system, results never change
+        for name in names:
+            src = source.path(src_group, name)
+            dst = self.path(dst_group, name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.exists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+
+    def remove(self, group, names=None):
+        if names is None:
+            shutil.rmtree(self.group_dir(group), ignore_errors=True)
+            return
+
+        for name in names:
+            try:
+                os.remove(self.path(group, name))
+            except FileNotFoundError:
+                pass
+
+    def groups(self, with_sizes=False):
+        # yields (group, mtime, size), hard linked files are counted once
+        inodes = set()
+
+        def walk(path, level):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    if level < self.shard_levels:
+                        yield from walk(entry.path, level + 1)
+                        continue
+
+                    size = 0
+                    if with_sizes:
+                        with os.scandir(entry.path) as files:
+                            for file_entry in files:
+                                stat = file_entry.stat(follow_symlinks=False)
+                                if (stat.st_dev, stat.st_ino) not in inodes:
+                                    inodes.add((stat.st_dev, stat.st_ino))
+                                    size += stat.st_size
+
+                    yield entry.name, entry.stat().st_mtime, size
+
+        if os.path.isdir(self.root):
+            yield from walk(self.root, 0)
+
+    def send(self, group, name, **kwargs):
+        try:
+            directory = self.group_dir(group)
+        except ValueError:
+            raise NotFound()
+        return send_from_directory(directory, name, **kwargs)
+
+
+class S3Storage:
+    def __init__(self, bucket, prefix, endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("S3 storage needs boto3, pip install boto3")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self._client = None
+
+    def __getstate__(self):
+        # clients can't be pickled, pool processes make their own
+        return {**self.__dict__, "_client": None}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+        return self._client
+
+    def key(self, group, name=""):
+        check_name(group)
+        if name:
+            check_name(name)
+        return f"{self.prefix}{group}/{name}"
+
+    def save(self, group, name, data):
+        # the object is durable once put_object returns
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key(group, name),
+            Body=data,
+            ContentType=mimetypes.guess_type(name)[0] or "application/octet-stream",
+        )
+
+    def sync(self, group):
+        pass
+
+    def load(self, group, name):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key(group, name))
+        return response["Body"].read()
+
+    def chunks(self, group, name):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key(group, name))
+        yield from response["Body"].iter_chunks(CHUNK_SIZE)
+
+    def head(self, group, name):
+        try:
+            return self.client.head_object(
+                Bucket=self.bucket, Key=self.key(group, name)
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, group, name):
+        return self.head(group, name) is not None
+
+    def mtime(self, group, name):
+        return self.head(group, name)["LastModified"].timestamp()
+
+    def objects(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from page.get("Contents", [])
+
+    def list(self, group):
+        prefix = self.key(group)
+        return {
+            item["Key"][len(prefix) :]: item["Size"] for item in self.objects(prefix)
+        }
+
+    def copy(self, source, src_group, dst_group, names):
+        # server-side copies, nothing passes through the website
+        for name in names:
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=self.key(dst_group, name),
+                CopySource={
+                    "Bucket": source.bucket,
+                    "Key": source.key(src_group, name),
+                },
+            )
+
+    def remove(self, group, names=None):
+        if names is None:
+            keys = [item["Key"] for item in self.objects(self.key(group))]
+        else:
+            keys = [self.key(group, name) for name in names]
+
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[start : start + 1000]],
+                    "Quiet": True,
+                },
+            )
+
+    def groups(self, with_sizes=False):
+        # one listing of the area, groups are aggregated from object keys
+        groups = {}
+        for item in self.objects(self.prefix):
+            group = item["Key"][len(self.prefix) :].split("/", 1)[0]
+            mtime, size = groups.get(group, (0, 0))
+            groups[group] = (
+                max(mtime, item["LastModified"].timestamp()),
+                size + item["Size"],
+            )
+
+        for group, (mtime, size) in groups.items():
+            yield group, mtime, size if with_sizes else 0
+
+    def send(self, group, name, **kwargs):
+        try:
+            data = self.load(group, name)
+        except (ValueError, ClientError):
+            raise NotFound()
+        return send_file(io.BytesIO(data), download_name=name, **kwargs)
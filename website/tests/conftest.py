@@ -0,0 +1,82 @@
+import os
+import sys
+import sqlite3
+from datetime import datetime as dt
+
+import pytest
+
+WEBSITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEBSITE_DIR)
+
+import admission  # noqa: E402
+import db  # noqa: E402
+import scheduler  # noqa: E402
+import server  # noqa: E402
+
+
+@pytest.fixture
+def app_dir(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / "database")
+
+    with open(os.path.join(WEBSITE_DIR, "database", "schema.sql")) as fp:
+        connection = sqlite3.connect(tmp_path / "database" / "database.db")
+        connection.executescript(fp.read())
+        connection.close()
+
+    monkeypatch.chdir(tmp_path)
+    db.configure(str(tmp_path / "database" / "database.db"))
+    server.app.testing = True
+
+    # rate limits and throughput are kept between requests, not in the database
+    monkeypatch.setattr(
+        admission,
+        "_sessions",
+        admission.TokenBuckets(
+            admission.SESSION_BURST, admission.SESSION_INTERVAL_SECONDS
+        ),
+    )
+    monkeypatch.setattr(
+        admission,
+        "_addresses",
+        admission.TokenBuckets(
+            admission.ADDRESS_BURST, admission.ADDRESS_INTERVAL_SECONDS
+        ),
+    )
+    monkeypatch.setitem(scheduler._throughput, "updated", None)
+    return tmp_path
+
+
+def submit_sessions(n_sessions, prompt="prompt number"):
+    # a session per prompt, as separate browsers
+    for ind in range(n_sessions):
+        client = server.app.test_client()
+        response = client.get(f"/get_results?text={prompt} {ind}")
+        assert response.status_code == 302
+
+
+def claim_all():
+    client = server.app.test_client()
+    data = []
+    while True:
+        response = client.post("/api/v1/get_task", json={"token": server.TOKEN})
+        if response.json["result"] == 0:
+            return data
+        data += response.json["data"]
+
+
+def insert_jobs(jobs, n_queued):
+    # jobs are (started, finished) pairs of done requests
+    rows = [
+        (f"done{ind}", db.STAT_DONE, started, started, finished)
+        for ind, (started, finished) in enumerate(jobs)
+    ]
+    rows += [
+        (f"queued{ind}", db.STAT_QUEUED, dt.now(), None, None)
+        for ind in range(n_queued)
+    ]
+    with db.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO requests (id, stat, created, started, finished) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
@@ -0,0 +1,93 @@
+from datetime import datetime as dt, timedelta
+
+import pytest
+
+import admission
+import db
+import scheduler
+import server
+from conftest import insert_jobs
+
+
+def test_session_is_rate_limited(app_dir):
+    client = server.app.test_client()
+
+    for ind in range(3):
+        response = client.get(f"/get_results?text=limited prompt {ind}")
+        assert response.status_code == 302
+        with client.session_transaction() as user_session:
+            db.set_status([user_session["username"]], db.STAT_ERROR)
+
+    response = client.get("/get_results?text=limited prompt 3")
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 30
+
+
+def test_long_queue_is_deferred(app_dir, monkeypatch):
+    monkeypatch.setattr(admission, "MAX_QUEUE_LENGTH", 2)
+
+    for ind in range(2):
+        client = server.app.test_client()
+        response = client.get(f"/get_results?text=queued prompt {ind}")
+        assert response.status_code == 302
+
+    client = server.app.test_client()
+    response = client.get("/get_results?text=queued prompt 2")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) == admission.MAX_RETRY_AFTER_SECONDS
+    assert db.get_queue_length() == 2
+
+
+def test_throughput_after_restart(app_dir):
+    # a few seconds of history must not look like 15 quiet minutes
+    now = dt.now()
+    insert_jobs([(now - timedelta(seconds=10), now)] * 3, 20)
+
+    throughput = scheduler.get_throughput()
+    assert throughput["jobs_per_second"] == pytest.approx(3 / 10)
+
+    client = server.app.test_client()
+    response = client.get("/get_results?text=after restart")
+    assert response.status_code == 302
+
+
+def test_throughput_after_quiet_period(app_dir, monkeypatch):
+    # three 10 second jobs in 15 minutes, the workers were idle, not slow
+    now = dt.now()
+    jobs = [
+        (now - timedelta(minutes=minutes, seconds=10), now - timedelta(minutes=minutes))
+        for minutes in (1, 6, 11)
+    ]
+    insert_jobs(jobs, 3)
+
+    throughput = scheduler.get_throughput()
+    assert throughput["jobs_per_second"] == pytest.approx(0.1)
+    assert throughput["service_time"] == pytest.approx(10)
+    assert admission.estimated_wait() == (3, pytest.approx(40))
+
+    monkeypatch.setattr(admission, "MAX_WAIT_SECONDS", 60)
+    client = server.app.test_client()
+    response = client.get("/get_results?text=after quiet period")
+    assert response.status_code == 302
+
+
+def test_batched_jobs_overlap():
+    intervals = [(0, 10), (0, 10), (5, 12), (20, 25)]
+    assert scheduler.busy_seconds(intervals) == 17
+
+
+def test_idle_worker_gets_retry_after(app_dir):
+    client = server.app.test_client()
+    response = client.post("/api/v1/get_task", json={"token": server.TOKEN})
+    assert response.json["result"] == 0
+    retry_after = response.json["retry_after_seconds"]
+    assert (
+        admission.MIN_TASK_RETRY_SECONDS
+        <= retry_after
+        <= admission.MAX_TASK_RETRY_SECONDS
+    )
+
+    response = client.post(
+        "/api/v1/get_task", json={"token": server.TOKEN, "wait": 0.1}
+    )
+    assert response.json == {"result": 0, "long_poll": True}
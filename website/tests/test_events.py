@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+import db
+import server
+
+
+def read_events(response):
+    for chunk in response.response:
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        fields = dict(
+            line.split(": ", 1) for line in chunk.strip().splitlines() if ": " in line
+        )
+        yield fields["event"], json.loads(fields["data"])
+
+
+def test_status_set_by_another_process(app_dir, monkeypatch):
+    monkeypatch.setattr(server, "EVENTS_HEARTBEAT_SECONDS", 0.1)
+
+    client = server.app.test_client()
+    client.get("/get_results?text=events prompt")
+    with client.session_transaction() as session:
+        user_id = session["username"]
+
+    events = read_events(client.get("/api/v1/events", buffered=False))
+    assert next(events) == ("status", {"status": db.STAT_QUEUED})
+    assert next(events)[0] == "queue"
+
+    # another server process changes the row, nothing is published here
+    with db.transaction():
+        db.set_status([user_id], db.STAT_DONE)
+
+    for event, data in events:
+        if event == "status":
+            assert data == {"status": db.STAT_DONE}
+            break
+    else:
+        pytest.fail("the status change wasn't sent")
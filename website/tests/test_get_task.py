@@ -0,0 +1,91 @@
+import sqlite3
+import threading
+from collections import Counter
+from datetime import datetime as dt, timedelta
+
+import pytest
+
+import scheduler
+import server
+from conftest import claim_all, insert_jobs, submit_sessions
+
+N_SESSIONS = 60
+N_WORKERS = 16
+
+
+def test_each_task_is_claimed_once(app_dir):
+    submit_sessions(N_SESSIONS)
+
+    claimed = []
+    claimed_lock = threading.Lock()
+    barrier = threading.Barrier(N_WORKERS)
+
+    def worker(worker_id):
+        client = server.app.test_client()
+        barrier.wait()
+
+        while True:
+            response = client.post(
+                "/api/v1/get_task", json={"token": server.TOKEN, "worker_id": worker_id}
+            )
+            assert response.status_code == 200
+            if response.json["result"] == 0:
+                break
+
+            with claimed_lock:
+                claimed.extend(
+                    (item["id"], worker_id) for item in response.json["data"]
+                )
+
+    threads = [
+        threading.Thread(target=worker, args=(f"worker-{ind}",))
+        for ind in range(N_WORKERS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counts = Counter(user_id for user_id, _ in claimed)
+    assert len(counts) == N_SESSIONS
+    assert max(counts.values()) == 1
+
+    connection = sqlite3.connect(app_dir / "database" / "database.db")
+    rows = dict(connection.execute("SELECT id, worker FROM requests WHERE stat=2"))
+    connection.close()
+
+    assert rows == dict(claimed)
+
+
+def test_tasks_are_claimed_in_submission_order(app_dir, monkeypatch):
+    monkeypatch.setitem(scheduler.API_KEYS, "api-key", "api")
+
+    queue = []
+    for ind in range(7):
+        client = server.app.test_client()
+        headers = {"X-API-Key": "api-key"} if ind == 5 else {}
+        client.get(f"/get_results?text=ordered prompt {ind}", headers=headers)
+        queue.append(client.get("/api/v1/ready").json)
+
+    claimed = [item["text"] for item in claim_all()]
+
+    # the API client gets a head start, everyone else is served first come first
+    assert claimed == [f"ordered prompt {ind}" for ind in [5, 0, 1, 2, 3, 4, 6]]
+    assert [info["position"] for info in queue] == [0, 1, 2, 3, 4, 0, 6]
+
+
+def test_eta_follows_worker_capacity(app_dir):
+    # 10 second jobs, the last one 10 minutes ago
+    now = dt.now()
+    jobs = [
+        (now - timedelta(minutes=minutes, seconds=10), now - timedelta(minutes=minutes))
+        for minutes in (10, 12, 14)
+    ]
+    insert_jobs(jobs, 0)
+    submit_sessions(3, "eta prompt")
+
+    client = server.app.test_client()
+    client.get("/get_results?text=eta prompt 3")
+    info = client.get("/api/v1/ready").json
+    assert info["position"] == 3
+    assert info["eta"] == pytest.approx(40, abs=1)
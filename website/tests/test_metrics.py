@@ -0,0 +1,73 @@
+import result_cache
+import server
+from metrics import Histogram, Registry
+from conftest import submit_sessions
+
+
+def scrape(client):
+    response = client.get(
+        "/metrics", headers={"Authorization": f"Bearer {server.TOKEN}"}
+    )
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    return response.get_data(as_text=True)
+
+
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line[len(name) + 1 :])
+    return 0.0
+
+
+def test_metrics_need_the_token(app_dir):
+    client = server.app.test_client()
+    assert client.get("/metrics").status_code == 401
+
+
+def test_queue_depth_and_task_latency(app_dir):
+    submit_sessions(2, "metrics prompt")
+
+    client = server.app.test_client()
+    before = scrape(client)
+    assert sample(before, 'website_queue_depth{stat="queued"}') == 2
+    assert sample(before, 'website_queue_depth{stat="running"}') == 0
+
+    client.post("/api/v1/get_task", json={"token": server.TOKEN})
+
+    after = scrape(client)
+    assert sample(after, 'website_queue_depth{stat="queued"}') == 0
+    assert sample(after, 'website_queue_depth{stat="running"}') == 2
+
+    count = 'website_get_task_seconds_count{status="200"}'
+    assert sample(after, count) == sample(before, count) + 1
+
+
+def test_ingest_stats_report_the_cache_hit_rate(app_dir, monkeypatch):
+    monkeypatch.setitem(result_cache.STATS, "hits", 3)
+    monkeypatch.setitem(result_cache.STATS, "misses", 1)
+
+    client = server.app.test_client()
+    response = client.post("/api/v1/ingest_stats", json={"token": server.TOKEN})
+    assert response.status_code == 200
+    assert response.json["result_cache"]["hits"] == 3
+    assert response.json["result_cache"]["hit_rate"] == 0.75
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = Histogram(
+        "test_seconds", "Test", ["kind"], buckets=(0.1, 1), registry=registry
+    )
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, kind='a "b"')
+
+    assert registry.render().splitlines() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{kind="a \\"b\\"",le="0.1"} 2',
+        'test_seconds_bucket{kind="a \\"b\\"",le="1.0"} 3',
+        'test_seconds_bucket{kind="a \\"b\\"",le="+Inf"} 4',
+        'test_seconds_sum{kind="a \\"b\\""} 5.65',
+        'test_seconds_count{kind="a \\"b\\""} 4',
+    ]
@@ -0,0 +1,69 @@
+import io
+import base64
+
+import numpy as np
+from PIL import Image
+
+import db
+import server
+
+
+def preview_payload(user_id, step, steps=50):
+    img = np.random.randint(0, 255, (64, 64, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format="PNG")
+    return {
+        "token": server.TOKEN,
+        "id": user_id,
+        "step": step,
+        "steps": steps,
+        "image": {
+            "format": "png",
+            "shape": [64, 64, 3],
+            "dtype": "uint8",
+            "data": base64.b64encode(buffer.getvalue()).decode("ascii"),
+        },
+    }
+
+
+def test_preview_is_shown_while_running(app_dir):
+    leader = server.app.test_client()
+    leader.get("/get_results?text=preview prompt")
+
+    worker = server.app.test_client()
+    task = worker.post("/api/v1/get_task", json={"token": server.TOKEN}).json
+    user_id = task["data"][0]["id"]
+
+    # the same prompt joins the running job and gets its previews
+    follower = server.app.test_client()
+    follower.get("/get_results?text=preview prompt")
+
+    response = worker.post("/api/v1/preview", json=preview_payload(user_id, 20))
+    assert response.status_code == 202
+
+    for client in (leader, follower):
+        info = client.get("/api/v1/ready").json
+        assert info["status"] == db.STAT_RUNNING
+        assert info["progress"] == 40
+
+        response = client.get(info["preview"])
+        assert response.status_code == 200
+        with Image.open(io.BytesIO(response.data)) as img:
+            assert img.size == (64, 64)
+
+
+def test_preview_of_finished_task_is_ignored(app_dir):
+    client = server.app.test_client()
+    client.get("/get_results?text=finished prompt")
+    task = client.post("/api/v1/get_task", json={"token": server.TOKEN}).json
+    user_id = task["data"][0]["id"]
+    db.set_status([user_id], db.STAT_ERROR)
+
+    response = client.post("/api/v1/preview", json=preview_payload(user_id, 50))
+    assert response.status_code == 204
+    assert client.get("/progress").status_code == 404
+
+    payload = preview_payload(user_id, 10)
+    payload["image"]["format"] = "raw"
+    response = client.post("/api/v1/preview", json=payload)
+    assert response.status_code == 400
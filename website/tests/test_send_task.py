@@ -0,0 +1,184 @@
+import os
+import io
+import signal
+import base64
+
+import numpy as np
+from PIL import Image
+
+import db
+import ingest
+import server
+import storage
+from result_cache import generation_settings, image_shape
+from conftest import claim_all, submit_sessions
+
+N_SESSIONS = 6
+
+
+def task_shape(task):
+    return image_shape(generation_settings(task["tier"]))
+
+
+def encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def png_payload(shape):
+    img = np.random.randint(0, 255, shape, dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format="PNG")
+    return {
+        "format": "png",
+        "shape": list(shape),
+        "dtype": "uint8",
+        "data": encode(buffer.getvalue()),
+    }
+
+
+def raw_payload(shape, dtype="uint8"):
+    img = np.zeros(shape, dtype=dtype)
+    return {
+        "format": "raw",
+        "shape": list(shape),
+        "dtype": dtype,
+        "data": encode(img.tobytes()),
+    }
+
+
+def test_results_are_acknowledged_before_written(app_dir):
+    submit_sessions(N_SESSIONS, "ingest prompt")
+    tasks = claim_all()
+    assert len(tasks) == N_SESSIONS
+
+    client = server.app.test_client()
+    response = client.post(
+        "/api/v1/send_task",
+        json={
+            "token": server.TOKEN,
+            "result": len(tasks),
+            "data": [
+                {
+                    "id": task["id"],
+                    "images": {
+                        "0": png_payload(task_shape(task)),
+                        "1": raw_payload(task_shape(task)),
+                    },
+                }
+                for task in tasks
+            ],
+        },
+    )
+    assert response.status_code == 202
+    assert response.json["accepted"] == N_SESSIONS
+
+    assert ingest.wait_idle(timeout=60)
+
+    for task in tasks:
+        data = db.get_request(task["id"])
+        assert data["stat"] == db.STAT_DONE
+        assert db.get_images(data) == ["img_0.png", "img_1.png"]
+        for name in db.get_images(data):
+            image_data = storage.user_data().load(task["id"], name)
+            with Image.open(io.BytesIO(image_data)) as img:
+                assert img.size == task_shape(task)[1::-1]
+
+    stats = ingest.report()
+    assert stats["completed"] >= N_SESSIONS
+    assert stats["pending"] == 0
+
+
+def test_invalid_images_are_rejected(app_dir):
+    submit_sessions(N_SESSIONS, "ingest prompt")
+    tasks = claim_all()
+
+    client = server.app.test_client()
+    response = client.post(
+        "/api/v1/send_task",
+        json={
+            "token": server.TOKEN,
+            "result": 1,
+            "data": [{"id": tasks[0]["id"], "images": {"0": {"format": "bmp"}}}],
+        },
+    )
+    # the worker would send the same images again on an error response
+    assert response.status_code == 202
+    assert response.json == {"accepted": 0, "failed": 1}
+    assert db.get_status(tasks[0]["id"]) == db.STAT_ERROR
+
+
+def corrupt_payloads(shape):
+    h, w, c = shape
+    png = png_payload(shape)
+    return [
+        {**png, "data": encode(b"not a png image at all, just some bytes")},
+        {**png, "data": png["data"][:16]},
+        {**png_payload((h // 2, w, c)), "shape": list(shape)},
+        png_payload((h // 2, w, c)),
+        {**raw_payload(shape, dtype="float32"), "shape": list(shape)},
+        {**raw_payload((h // 2, w, c)), "shape": list(shape)},
+        {**raw_payload(shape), "data": "not base64!"},
+        {key: value for key, value in raw_payload(shape).items() if key != "shape"},
+    ]
+
+
+def test_corrupt_images_fail_only_their_job(app_dir):
+    shape = task_shape({"tier": "full"})
+    payloads = corrupt_payloads(shape)
+    submit_sessions(len(payloads) + 1, "ingest prompt")
+    tasks = claim_all()
+    assert all(task_shape(task) == shape for task in tasks)
+
+    items = [
+        {"id": task["id"], "images": {"0": payload}}
+        for task, payload in zip(tasks, payloads)
+    ]
+    items.append({"id": tasks[-1]["id"], "images": {"0": png_payload(shape)}})
+
+    client = server.app.test_client()
+    response = client.post(
+        "/api/v1/send_task",
+        json={"token": server.TOKEN, "result": len(items), "data": items},
+    )
+    assert response.status_code == 202
+    assert response.json == {"accepted": 1, "failed": len(payloads)}
+    assert ingest.wait_idle(timeout=60)
+
+    for task in tasks[:-1]:
+        assert db.get_status(task["id"]) == db.STAT_ERROR
+    assert db.get_status(tasks[-1]["id"]) == db.STAT_DONE
+
+
+def send_results(tasks):
+    client = server.app.test_client()
+    return client.post(
+        "/api/v1/send_task",
+        json={
+            "token": server.TOKEN,
+            "result": len(tasks),
+            "data": [
+                {"id": task["id"], "images": {"0": png_payload(task_shape(task))}}
+                for task in tasks
+            ],
+        },
+    )
+
+
+def test_pool_recovers_from_a_dead_process(app_dir):
+    submit_sessions(N_SESSIONS, "ingest prompt")
+    tasks = claim_all()
+
+    assert send_results(tasks[:1]).status_code == 202
+    assert ingest.wait_idle(timeout=60)
+
+    # a pool process killed by the OOM killer breaks the whole pool, the
+    # executor then terminates the others itself
+    process = next(iter(ingest.get_executor()._processes.values()))
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+
+    assert send_results(tasks[1:]).status_code == 202
+    assert ingest.wait_idle(timeout=60)
+
+    for task in tasks:
+        assert db.get_status(task["id"]) == db.STAT_DONE
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def local_storages(tmp_path):
+    return (
+        storage.LocalStorage(str(tmp_path / "user_data")),
+        storage.LocalStorage(str(tmp_path / "result_cache")),
+    )
+
+
+@pytest.fixture
+def s3_storages(monkeypatch):
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        boto3.client("s3").create_bucket(Bucket="results")
+        yield (
+            storage.S3Storage("results", "user_data/"),
+            storage.S3Storage("results", "result_cache/"),
+        )
+
+
+@pytest.fixture(params=["local", "s3"])
+def storages(request):
+    return request.getfixturevalue(f"{request.param}_storages")
+
+
+def test_storage_roundtrip(storages):
+    user_data, cache = storages
+
+    user_data.save("session1", "img_0.png", b"first")
+    user_data.save("session1", "img_1.png", b"second" * 100000)
+    user_data.sync("session1")
+
+    assert user_data.load("session1", "img_0.png") == b"first"
+    assert b"".join(user_data.chunks("session1", "img_1.png")) == b"second" * 100000
+    assert user_data.list("session1") == {"img_0.png": 5, "img_1.png": 600000}
+    assert user_data.exists("session1", "img_0.png")
+    assert not user_data.exists("session2", "img_0.png")
+    assert user_data.list("session2") == {}
+
+    cache.copy(user_data, "session1", "key1", ["img_0.png", "img_1.png"])
+    user_data.copy(cache, "key1", "session2", ["img_0.png"])
+    assert user_data.load("session2", "img_0.png") == b"first"
+
+    user_data.remove("session1", ["img_0.png"])
+    assert user_data.list("session1").keys() == {"img_1.png"}
+    assert cache.load("key1", "img_0.png") == b"first"
+
+    groups = {group: size for group, _, size in user_data.groups(with_sizes=True)}
+    assert groups.keys() == {"session1", "session2"}
+
+    user_data.remove("session1")
+    assert {group for group, _, _ in user_data.groups()} == {"session2"}
+
+    with pytest.raises(ValueError):
+        user_data.save("../session", "img_0.png", b"")
+    with pytest.raises(ValueError):
+        user_data.load("session2", "../img_0.png")
+
+
+def test_local_storage_is_sharded(local_storages):
+    user_data, _ = local_storages
+    user_data.save("0123456789abcdef", "img_0.png", b"data")
+
+    path = user_data.path("0123456789abcdef", "img_0.png")
+    parts = os.path.relpath(path, user_data.root).split(os.sep)
+    assert len(parts) == 2 + storage.SHARD_LEVELS
+    assert all(len(part) == 2 for part in parts[: storage.SHARD_LEVELS])
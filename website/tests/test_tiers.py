@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import ingest
+import scheduler
+import server
+import storage
+from image_codec import LEGACY_SHAPE
+from result_cache import generation_settings, image_shape
+from conftest import claim_all, submit_sessions
+
+
+@pytest.fixture
+def app_dir(app_dir, monkeypatch):
+
+    monkeypatch.setattr(
+        scheduler, "TIER_QUEUE_LENGTHS", [("draft", 3), ("fast", 1), ("full", 0)]
+    )
+    return app_dir
+
+
+def test_tier_follows_backlog(app_dir):
+    submit_sessions(4, "tier prompt")
+
+    tasks = claim_all()
+    assert [task["tier"] for task in tasks] == ["full", "fast", "fast", "draft"]
+
+
+def test_shape_is_the_decoded_size():
+    # the model always sent 512x512 images for the 256x256 settings
+    assert image_shape(None) == LEGACY_SHAPE
+    assert image_shape(generation_settings("full")) == LEGACY_SHAPE
+    assert image_shape(generation_settings("draft")) == (384, 384, 3)
+
+
+def test_list_images_take_the_tier_shape(app_dir):
+    submit_sessions(4, "shape prompt")
+
+    task = claim_all()[-1]
+    assert task["tier"] == "draft"
+
+    # 192 // 4 latents decoded 8 times larger
+    img = np.random.randint(0, 255, (384, 384, 3), dtype=np.uint8)
+
+    client = server.app.test_client()
+    response = client.post(
+        "/api/v1/send_task",
+        json={
+            "token": server.TOKEN,
+            "result": 1,
+            "data": [{"id": task["id"], "images": {"0": img.flatten().tolist()}}],
+        },
+    )
+    assert response.status_code == 202
+    assert ingest.wait_idle(timeout=60)
+
+    image_data = storage.user_data().load(task["id"], "img_0.png")
+    with Image.open(io.BytesIO(image_data)) as saved:
+        assert saved.size == (384, 384)
+        assert np.array_equal(np.asarray(saved), img)
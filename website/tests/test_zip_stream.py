@@ -0,0 +1,26 @@
+import io
+import os
+import zipfile
+
+from zip_stream import make_entry, stream_zip, zip_size
+
+
+def test_stream_matches_zipfile():
+    files = {f"img_{ind}.png": os.urandom(100000 + ind * 12345) for ind in range(3)}
+
+    def open_chunks(name):
+        return lambda: iter([files[name][:1000], files[name][1000:]])
+
+    entries = [make_entry(name, open_chunks=open_chunks(name)) for name in files]
+    entries.append(make_entry("text.txt", data="котик в шляпе".encode("utf-8")))
+
+    archive = b"".join(stream_zip(entries))
+    assert len(archive) == zip_size(entries)
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == list(files) + ["text.txt"]
+        for name, data in files.items():
+            assert zip_file.getinfo(name).compress_type == zipfile.ZIP_STORED
+            assert zip_file.read(name) == data
+        assert zip_file.read("text.txt").decode("utf-8") == "котик в шляпе"
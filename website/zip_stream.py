@@ -0,0 +1,120 @@
+import time
+import zlib
+import struct
+
+# no zip64, sessions are a few images
+MAX_ZIP_SIZE = 0xFFFFFFFF
+
+ZIP_VERSION = 20
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    dos_date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_time, dos_date
+
+
+def make_entry(name, data=None, open_chunks=None, timestamp=None):
+    # crc is needed before the local header, so stored files are read twice,
+    # open_chunks returns a new iterator over the file for each pass
+    if open_chunks is not None:
+        crc = 0
+        size = 0
+        for chunk in open_chunks():
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    else:
+        crc = zlib.crc32(data)
+        size = len(data)
+
+    return {
+        "name": name.encode("utf-8"),
+        "open_chunks": open_chunks,
+        "data": data,
+        "crc": crc,
+        "size": size,
+        "datetime": dos_datetime(timestamp if timestamp is not None else time.time()),
+    }
+
+
+def zip_size(entries):
+    size = END_RECORD.size
+    for entry in entries:
+        size += LOCAL_HEADER.size + CENTRAL_HEADER.size + 2 * len(entry["name"])
+        size += entry["size"]
+    return size
+
+
+def stream_zip(entries):
+    # ZIP_STORED: PNG files are compressed already
+    if zip_size(entries) > MAX_ZIP_SIZE:
+        raise ValueError("Archive is too large")
+
+    offset = 0
+    central_directory = []
+    for entry in entries:
+        flags = 0 if entry["name"].isascii() else FLAG_UTF8
+        dos_time, dos_date = entry["datetime"]
+
+        local_header = LOCAL_HEADER.pack(
+            0x04034B50,
+            ZIP_VERSION,
+            flags,
+            0,
+            dos_time,
+            dos_date,
+            entry["crc"],
+            entry["size"],
+            entry["size"],
+            len(entry["name"]),
+            0,
+        )
+        central_directory.append(
+            CENTRAL_HEADER.pack(
+                0x02014B50,
+                ZIP_VERSION,
+                ZIP_VERSION,
+                flags,
+                0,
+                dos_time,
+                dos_date,
+                entry["crc"],
+                entry["size"],
+                entry["size"],
+                len(entry["name"]),
+                0,
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                offset,
+            )
+            + entry["name"]
+        )
+
+        yield local_header + entry["name"]
+        if entry["open_chunks"] is not None:
+            yield from entry["open_chunks"]()
+        else:
+            yield entry["data"]
+
+        offset += len(local_header) + len(entry["name"]) + entry["size"]
+
+    central_directory = b"".join(central_directory)
+    yield central_directory + END_RECORD.pack(
+        0x06054B50,
+        0,
+        0,
+        len(entries),
+        len(entries),
+        len(central_directory),
+        offset,
+        0,
+    )
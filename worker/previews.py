@@ -0,0 +1,78 @@
+import json
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from typing import Dict
+
+import requests
+from omegaconf import OmegaConf
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class PreviewRelay:
+    # the model posts previews while sampling, they are forwarded to the site
+    # in the background, a newer preview of the same task replaces the old one
+    def __init__(
+        self, conf: OmegaConf, session: requests.Session, logger: Logger
+    ) -> None:
+        self.conf = conf
+        self.session = session
+        self.logger = logger
+        self.pending: Dict[str, Dict] = {}
+        self.condition = threading.Condition()
+
+    def start(self) -> None:
+        relay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                if length > MAX_BODY_SIZE:
+                    self.send_response(413)
+                    self.end_headers()
+                    return
+
+                try:
+                    item = json.loads(self.rfile.read(length))
+                    relay.put(item)
+                except Exception:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                self.send_response(202)
+                self.end_headers()
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer(
+            (self.conf.previews.host, self.conf.previews.port), Handler
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def put(self, item: Dict) -> None:
+        with self.condition:
+            self.pending[str(item["id"])] = item
+            self.condition.notify()
+
+    def run(self) -> None:
+        coordinator = self.conf.coordinator_access
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                item = self.pending.pop(next(iter(self.pending)))
+
+            try:
+                response = self.session.post(
+                    coordinator.url_preview,
+                    json={**item, "token": coordinator.token},
+                    timeout=coordinator.timeout,
+                )
+                response.raise_for_status()
+            except Exception:
+                self.logger.debug(traceback.format_exc())
+                self.logger.info("Error sending preview to coordinator")
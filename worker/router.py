@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import requests
+from omegaconf import OmegaConf
+
+from metrics import Counter
+
+MODEL_PATH = "/v1/models/{model_name}"
+
+# a streamed line holds all images of an item, read it in large chunks
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+RETRIES = Counter("worker_retries_total", "Retried requests by stage", ["stage"])
+
+
+class Replica:
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+
+class ModelRouter:
+    # items of a claimed task are split between model replicas, each one gets
+    # the next item while it has the fewest items in flight, with on_item the
+    # results are streamed and passed on one by one
+    def __init__(
+        self, conf: OmegaConf, session: requests.Session, logger: Logger
+    ) -> None:
+        urls = list(conf.get("replicas") or [f"http://localhost:{conf.port}"])
+
+        self.conf = conf
+        self.session = session
+        self.logger = logger
+        self.replicas = [Replica(url) for url in urls]
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.replicas))
+        self.stop = threading.Event()
+
+    def model_url(self, replica: Replica) -> str:
+        return replica.url + MODEL_PATH.format(model_name=self.conf.model_name)
+
+    def start_health_checks(self) -> None:
+        if self.conf.get("health_check_seconds", 0) <= 0:
+            return
+
+        # the first round is done before any task is routed
+        for replica in self.replicas:
+            self.check(replica)
+
+        thread = threading.Thread(target=self.health_check_loop, daemon=True)
+        thread.start()
+
+    def health_check_loop(self) -> None:
+        while not self.stop.wait(self.conf.health_check_seconds):
+            for replica in self.replicas:
+                self.check(replica)
+
+    def check(self, replica: Replica) -> None:
+        # kfserving answers {"name": ..., "ready": true} when the model is loaded
+        try:
+            response = self.session.get(
+                self.model_url(replica), timeout=self.conf.health_check_timeout
+            )
+            healthy = response.ok and response.json().get("ready", True)
+        except Exception:
+            healthy = False
+
+        with self.lock:
+            if healthy != replica.healthy:
+                self.logger.info(
+                    "Model replica %s is %s",
+                    replica.url,
+                    "healthy" if healthy else "not healthy",
+                )
+            replica.healthy = healthy
+
+    def record_failure(self, replica: Replica) -> None:
+        with self.lock:
+            replica.failures += 1
+            if replica.failures < self.conf.eject_after_failures:
+                return
+
+            replica.failures = 0
+            replica.ejected_until = time.monotonic() + self.conf.eject_seconds
+
+        self.logger.info(
+            "Model replica %s is ejected for %s seconds",
+            replica.url,
+            self.conf.eject_seconds,
+        )
+
+    def record_success(self, replica: Replica) -> None:
+        with self.lock:
+            replica.failures = 0
+
+    def assign(
+        self, items: List[Dict], failed: Set[str]
+    ) -> List[Tuple[Replica, List[Dict]]]:
+        with self.lock:
+            now = time.monotonic()
+            replicas = [
+                replica
+                for replica in self.replicas
+                if replica.available(now) and replica.url not in failed
+            ]
+            if not replicas:
+                raise RuntimeError("No model replicas available")
+
+            parts = {replica.url: [] for replica in replicas}
+            for item in items:
+                replica = min(replicas, key=lambda replica: replica.outstanding)
+                replica.outstanding += 1
+                parts[replica.url].append(item)
+
+        return [
+            (replica, parts[replica.url]) for replica in replicas if parts[replica.url]
+        ]
+
+    def post(
+        self, replica: Replica, query: Dict, on_item: Optional[Callable] = None
+    ) -> Dict:
+        try:
+            if on_item is not None:
+                return self.post_stream(replica, query, on_item)
+
+            response = self.session.post(
+                self.model_url(replica) + ":predict",
+                json=query,
+                timeout=self.conf.timeout,
+            )
+            response.raise_for_status()
+            return response.json()
+        finally:
+            with self.lock:
+                replica.outstanding -= len(query["data"])
+
+    def post_stream(self, replica: Replica, query: Dict, on_item: Callable) -> Dict:
+        # one NDJSON line per item, each one is passed on as soon as it is read
+        data = []
+        with self.session.post(
+            self.model_url(replica) + ":predict_stream",
+            json=query,
+            timeout=self.conf.timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                if line:
+                    item = json.loads(line)
+                    data.append(item)
+                    on_item(item)
+
+        return {"data": data, "result": len(data)}
+
+    def predict(self, query: Dict, on_item: Optional[Callable] = None) -> Dict:
+        results = {}
+        image_format = None
+        pending = query["data"]
+        failed = set()
+
+        def received(item: Dict) -> None:
+            with self.lock:
+                results[item["id"]] = item
+            on_item(item)
+
+        stream = received if on_item is not None else None
+
+        # items of a failed replica are sent to the others, streamed items
+        # are done already
+        for attempt in range(len(self.replicas)):
+            if not pending:
+                break
+            if attempt > 0:
+                RETRIES.inc(len(pending), stage="reroute")
+
+            futures = [
+                (
+                    replica,
+                    part,
+                    self.executor.submit(
+                        self.post,
+                        replica,
+                        {**query, "data": part, "result": len(part)},
+                        stream,
+                    ),
+                )
+                for replica, part in self.assign(pending, failed)
+            ]
+
+            pending = []
+            for replica, part, future in futures:
+                try:
+                    response = future.result()
+                except Exception:
+                    self.logger.error(traceback.format_exc())
+                    self.logger.info("Error getting images from %s", replica.url)
+                    self.record_failure(replica)
+                    failed.add(replica.url)
+                    pending += [item for item in part if item["id"] not in results]
+                    continue
+
+                self.record_success(replica)
+                image_format = response.get("format", image_format)
+                for item in response["data"]:
+                    results[item["id"]] = item
+
+        if pending:
+            raise RuntimeError("Model replicas failed to process the task")
+
+        output = [
+            results[item["id"]] for item in query["data"] if item["id"] in results
+        ]
+        result = {"data": output, "result": len(output)}
+        if image_format is not None:
+            result["format"] = image_format
+
+        return result
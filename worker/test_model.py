@@ -0,0 +1,90 @@
+import argparse
+import json
+import base64
+import time
+
+import numpy as np
+from flask import Flask, Response, jsonify, request
+
+from logger import get_logger
+
+IMAGE_SHAPE = [512, 512, 3]
+N_IMAGES = 3
+
+app = Flask(__name__)
+ARGS = None
+LOGGER = None
+
+
+def get_image():
+    data = np.random.randint(0, 255, IMAGE_SHAPE, dtype=np.uint8)
+    return {
+        "format": "raw",
+        "shape": IMAGE_SHAPE,
+        "dtype": "uint8",
+        "data": base64.b64encode(data.tobytes()).decode("ascii"),
+    }
+
+
+@app.route("/v1/models/<name>", methods=["GET"])
+def model_status(name):
+    return jsonify({"name": name, "ready": not ARGS.not_ready})
+
+
+@app.route("/v1/models/<name>:predict", methods=["POST"])
+def predict(name):
+    content = request.json
+
+    if np.random.rand() < ARGS.fail_rate:
+        LOGGER.info(f"Failing task with len {len(content['data'])}")
+        return ("", 500)
+
+    time.sleep(ARGS.delay * len(content["data"]))
+
+    LOGGER.info(f"Got task with len {len(content['data'])}")
+
+    output = [
+        {"id": item["id"], "images": {str(ind): get_image() for ind in range(N_IMAGES)}}
+        for item in content["data"]
+    ]
+
+    return jsonify({"data": output, "result": len(output), "format": "raw"})
+
+
+@app.route("/v1/models/<name>:predict_stream", methods=["POST"])
+def predict_stream(name):
+    content = request.json
+
+    if np.random.rand() < ARGS.fail_rate:
+        LOGGER.info(f"Failing task with len {len(content['data'])}")
+        return ("", 500)
+
+    def generate():
+        for item in content["data"]:
+            time.sleep(ARGS.delay)
+            images = {str(ind): get_image() for ind in range(N_IMAGES)}
+            yield json.dumps({"id": item["id"], "images": images}) + "\n"
+
+        LOGGER.info(f"Streamed task with len {len(content['data'])}")
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=1.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--not-ready", action="store_true")
+
+    global ARGS
+    ARGS = parser.parse_args()
+
+    global LOGGER
+    LOGGER = get_logger(f"test_model_{ARGS.port}")
+
+    app.run(port=ARGS.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 # pylint: disable=W0603
+import base64
+import gzip
+import json
 import secrets
 
 import numpy as np
@@ -7,12 +10,20 @@ from omegaconf import OmegaConf
 
 from logger import get_logger
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 ENGLISH_ALPABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 WHITESPACE = " "
 
 ALPHABET = ENGLISH_ALPABET + WHITESPACE
 ALPHABET_LIST = list(ALPHABET)
 
+IMAGE_FORMATS = ["png", "raw", "list"]
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
 app = Flask(__name__)
 TOKEN = None
 CONF = None
@@ -42,6 +53,7 @@ def get_task(size: int, conf):
             {"id": item_id, "text": text}
             for item_id, text in zip(ids, texts)
         ],
+        "formats": IMAGE_FORMATS,
     }
 
     return query
@@ -66,6 +78,37 @@ def get_random_task(conf: OmegaConf):
     return get_nothing_task()
 
 
+def get_json():
+    encoding = request.headers.get("Content-Encoding", "identity")
+
+    if encoding == "gzip":
+        return json.loads(gzip.decompress(request.get_data()))
+
+    if encoding == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(request.get_data())
+        return json.loads(reader.read())
+
+    assert encoding == "identity", encoding
+    return request.json
+
+
+def check_image(image):
+    if isinstance(image, list):
+        assert len(image) == 512 * 512 * 3
+        return
+
+    assert image["format"] in IMAGE_FORMATS, image["format"]
+    assert len(image["shape"]) == 3, image["shape"]
+
+    data = base64.b64decode(image["data"])
+
+    if image["format"] == "raw":
+        item_size = np.dtype(image["dtype"]).itemsize
+        assert len(data) == int(np.prod(image["shape"])) * item_size
+    else:
+        assert data.startswith(PNG_SIGNATURE)
+
+
 @app.route("/api/v1/stage_sd/get_task", methods=["POST"])
 def send_query():
     assert request.json["token"] == TOKEN
@@ -81,20 +124,36 @@ def send_query():
 
 @app.route("/api/v1/stage_sd/result", methods=["POST"])
 def recieve_answer():
-    assert request.json["token"] == TOKEN
+    content = get_json()
+    assert content["token"] == TOKEN
 
-    for item in request.json["data"]:
-        assert len(item["images"]["0"]) == 512 * 512 * 3
-        assert len(item["images"]["1"]) == 512 * 512 * 3
-        assert len(item["images"]["2"]) == 512 * 512 * 3
+    for item in content["data"]:
+        check_image(item["images"]["0"])
+        check_image(item["images"]["1"])
+        check_image(item["images"]["2"])
 
-    info = f"Got task with len: {request.json['result']}"
+    info = f"Got task with len: {content['result']}"
 
     LOGGER.info(info)
 
     return ("", 200)
 
 
+@app.route("/api/v1/stage_sd/preview", methods=["POST"])
+def recieve_preview():
+    content = request.json
+    assert content["token"] == TOKEN
+
+    data = base64.b64decode(content["image"]["data"])
+    assert data.startswith(PNG_SIGNATURE)
+
+    info = f"Got preview for {content['id']}: step {content['step']}/{content['steps']}"
+
+    LOGGER.info(info)
+
+    return ("", 202)
+
+
 def main():
     conf = OmegaConf.load("server_config.yaml")
 
@@ -1,27 +1,146 @@
 # pylint: disable=W0703
+import gzip
+import json
+import os
+import queue
+import socket
+import signal
+import threading
 import time
 import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from logging import Logger
-from typing import Dict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 import requests
 from omegaconf import OmegaConf
+from requests.adapters import HTTPAdapter
 
 from logger import get_logger
-
-
-def get_task(conf: OmegaConf) -> Dict:
-    query = {"token": conf.token}
-
-    response = requests.post(conf.url_get, json=query, timeout=conf.timeout)
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Histogram
+from previews import PreviewRelay
+from router import RETRIES, ModelRouter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LEGACY_FORMAT = "list"
+
+# marks the end of the stream of tasks between pipeline stages
+STOP = object()
+
+SESSIONS: Dict[str, requests.Session] = {}
+SESSIONS_LOCK = threading.Lock()
+
+ROUTER: Optional[ModelRouter] = None
+ROUTER_LOCK = threading.Lock()
+
+GET_TASK_SECONDS = Histogram(
+    "worker_get_task_seconds", "get_task latency, long polls included", ["result"]
+)
+SEND_TASK_SECONDS = Histogram("worker_send_task_seconds", "send_task latency")
+MODEL_SECONDS = Histogram("worker_model_seconds", "Model time of a claimed task")
+
+
+class StateTimer:
+    # seconds spent in each state, the current period is counted when scraped
+    def __init__(self, state: str) -> None:
+        self.state = state
+        self.since = time.monotonic()
+        self.totals: Dict[str, float] = {state: 0.0}
+        self.lock = threading.Lock()
+
+    def set(self, state: str) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.totals[self.state] += now - self.since
+            self.totals.setdefault(state, 0.0)
+            self.state, self.since = state, now
+
+    def get_totals(self) -> Dict[str, float]:
+        with self.lock:
+            totals = dict(self.totals)
+            totals[self.state] += time.monotonic() - self.since
+            return totals
+
+
+# busy while a claimed task is processed, idle while the worker waits for one
+WORKER_STATE = StateTimer("idle")
+Counter(
+    "worker_seconds_total",
+    "Time spent busy and idle",
+    ["state"],
+    function=WORKER_STATE.get_totals,
+)
+
+
+def get_session(name: str, conf: OmegaConf) -> requests.Session:
+    # keep-alive connections are reused between tasks and pipeline stages
+    with SESSIONS_LOCK:
+        if name not in SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=conf.pool_size, pool_maxsize=conf.pool_size
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            SESSIONS[name] = session
+
+        return SESSIONS[name]
+
+
+def compress_body(query: Dict, compression: str) -> Tuple[bytes, Dict[str, str]]:
+    body = json.dumps(query).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+
+    if compression == "zstd" and zstandard is None:
+        compression = "gzip"
+
+    if compression == "gzip":
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    elif compression == "zstd":
+        body = zstandard.ZstdCompressor(level=3).compress(body)
+        headers["Content-Encoding"] = "zstd"
+
+    return body, headers
+
+
+def get_worker_id(conf: OmegaConf) -> str:
+    if conf.worker_id:
+        return conf.worker_id
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def get_task(conf: OmegaConf, sleep: Callable[[float], Any] = time.sleep) -> Dict:
+    query = {"token": conf.token, "worker_id": get_worker_id(conf)}
+    timeout = conf.timeout
+
+    # the coordinator holds the request until a task appears or time is out
+    if conf.long_poll_seconds > 0:
+        query["wait"] = conf.long_poll_seconds
+        timeout += conf.long_poll_seconds
+
+    session = get_session("coordinator", conf)
+    started = time.perf_counter()
+    response = session.post(conf.url_get, json=query, timeout=timeout)
     response.raise_for_status()
 
+    result = "empty" if response.json()["result"] == 0 else "tasks"
+    GET_TASK_SECONDS.observe(time.perf_counter() - started, result=result)
+
     if response.json()["result"] == 0:
         if "retry_after_seconds" in response.json():
             waiting_time = response.json()["retry_after_seconds"]
+        elif response.json().get("long_poll"):
+            waiting_time = 0
         else:
             waiting_time = conf.retry_after_seconds
-        time.sleep(waiting_time)
+
+        if waiting_time > 0:
+            sleep(waiting_time)
 
         output_query = {}
 
@@ -31,15 +150,44 @@ def get_task(conf: OmegaConf) -> Dict:
     return output_query
 
 
-def model_calculation(query: Dict, conf: OmegaConf) -> Dict:
-    url_pattern = "http://localhost:{port}/v1/models/{model_name}:predict"
+def negotiate_format(preferred: str, coordinator_formats: List[str]) -> str:
+    # coordinators which don't announce formats only understand flat lists
+    if preferred in coordinator_formats:
+        return preferred
+    return LEGACY_FORMAT
 
-    url = url_pattern.format(port=conf.port, model_name=conf.model_name)
 
-    response = requests.post(url, json=query, timeout=conf.timeout)
-    response.raise_for_status()
+def get_router(conf: OmegaConf, logger: Logger) -> ModelRouter:
+    global ROUTER
+
+    with ROUTER_LOCK:
+        if ROUTER is None:
+            ROUTER = ModelRouter(conf, get_session("model", conf), logger)
+            ROUTER.start_health_checks()
+
+        return ROUTER
+
 
-    return response.json()
+def model_calculation(
+    query: Dict,
+    conf: OmegaConf,
+    logger: Logger,
+    preview_url: Optional[str] = None,
+    on_item: Optional[Callable[[Dict], Any]] = None,
+) -> Dict:
+    query = {
+        **query,
+        "format": negotiate_format(
+            conf.image_format, query.get("formats", [LEGACY_FORMAT])
+        ),
+    }
+
+    # the model sends previews to the relay while sampling
+    if preview_url:
+        query["preview_url"] = preview_url
+
+    with MODEL_SECONDS.time():
+        return get_router(conf, logger).predict(query, on_item)
 
 
 def error_result(query: Dict):
@@ -56,40 +204,82 @@ def error_result(query: Dict):
     return result
 
 
+def without_items(query: Dict, ids: Set[str]) -> Dict:
+    data = [item for item in query["data"] if item["id"] not in ids]
+    return {**query, "data": data, "result": len(data)}
+
+
 def result_postprocess(query: Dict, conf: OmegaConf) -> Dict:
     query["token"] = conf.token
     return query
 
 
 def send_query(query: Dict, conf: OmegaConf) -> None:
-    response = requests.post(conf.url_send, json=query, timeout=conf.timeout)
+    body, headers = compress_body(query, conf.compression)
+
+    session = get_session("coordinator", conf)
+    with SEND_TASK_SECONDS.time():
+        response = session.post(
+            conf.url_send, data=body, headers=headers, timeout=conf.timeout
+        )
     response.raise_for_status()
 
 
-def worker_step(conf: OmegaConf, logger: Logger) -> None:
+def fetch_query(
+    conf: OmegaConf, logger: Logger, sleep: Callable[[float], Any] = time.sleep
+) -> Dict:
     # Getting query from coordinator
     while True:
         try:
-            query = get_task(conf.coordinator_access)
-            break
+            return get_task(conf.coordinator_access, sleep=sleep)
 
         except Exception:
             logger.error(traceback.format_exc())
             logger.info("Error getting task from coordinator")
-            time.sleep(conf.coordinator_access.coord_sleep_time)
-
-    # If an empty query was returned, start a new loop
-    if not query or query["result"] == 0:
-        return
+            RETRIES.inc(stage="get_task")
+            # sleep returns True only when the pipeline is stopping
+            if sleep(conf.coordinator_access.coord_sleep_time):
+                return {}
+
+
+def compute_result(
+    query: Dict,
+    conf: OmegaConf,
+    logger: Logger,
+    on_item: Optional[Callable[[Dict], Any]] = None,
+) -> Optional[Dict]:
+    preview_url = conf.previews.url if conf.previews.enabled else None
+
+    # with streaming every finished item goes to on_item as a query of its
+    # own right away, retries and the returned query cover the rest
+    streamed: Set[str] = set()
+    stream = None
+    if on_item is not None and conf.model_access.streaming:
+
+        def stream(item: Dict) -> None:
+            streamed.add(item["id"])
+            on_item(
+                result_postprocess(
+                    query={"data": [item], "result": 1},
+                    conf=conf.coordinator_access,
+                )
+            )
 
     for _ in range(conf.model_access.model_retries):
         try:
-            result = model_calculation(query=query, conf=conf.model_access)
+            result = model_calculation(
+                query=without_items(query, streamed),
+                conf=conf.model_access,
+                logger=logger,
+                preview_url=preview_url,
+                on_item=stream,
+            )
             break
 
         except Exception:
             logger.error(traceback.format_exc())
             logger.info("Error getting images")
+            RETRIES.inc(stage="model")
             time.sleep(conf.model_access.model_sleep_time)
 
     # If model not responding, send error query
@@ -98,21 +288,27 @@ def worker_step(conf: OmegaConf, logger: Logger) -> None:
             "The maximum number of attempts to get results from the model has been reached"
         )
         try:
-            result = error_result(query)
+            result = error_result(without_items(query, streamed))
         except Exception:
             logger.error(traceback.format_exc())
             logger.info("Error getting error query")
-            return
+            return None
+
+    result = without_items(result, streamed)
+    if streamed and result["result"] == 0:
+        return None
 
     # Do some modifications before sending to coordinator
     try:
-        output_query = result_postprocess(query=result, conf=conf.coordinator_access)
+        return result_postprocess(query=result, conf=conf.coordinator_access)
 
     except Exception:
         logger.error(traceback.format_exc())
         logger.info("Error postprocessing query")
-        return
+        return None
+
 
+def upload_result(output_query: Dict, conf: OmegaConf, logger: Logger) -> None:
     # Sending result to coordinator
     for _ in range(conf.coordinator_access.sending_results_retries):
         try:
@@ -121,6 +317,7 @@ def worker_step(conf: OmegaConf, logger: Logger) -> None:
         except Exception:
             logger.error(traceback.format_exc())
             logger.info("Error sending results to coordinator")
+            RETRIES.inc(stage="send_task")
 
     else:
         logger.info(
@@ -128,10 +325,132 @@ def worker_step(conf: OmegaConf, logger: Logger) -> None:
         )
 
 
+def worker_step(conf: OmegaConf, logger: Logger) -> None:
+    WORKER_STATE.set("idle")
+    query = fetch_query(conf, logger)
+
+    # If an empty query was returned, start a new loop
+    if not query or query["result"] == 0:
+        return
+
+    WORKER_STATE.set("busy")
+    output_query = compute_result(
+        query, conf, logger, on_item=lambda item: upload_result(item, conf, logger)
+    )
+    if output_query is None:
+        return
+
+    upload_result(output_query, conf, logger)
+
+
+def fetch_stage(
+    conf: OmegaConf, logger: Logger, tasks: queue.Queue, stop: threading.Event
+) -> None:
+    # the next task is prefetched while the model is busy, the bounded queue
+    # keeps the worker from claiming more tasks than it can start soon
+    while not stop.is_set():
+        query = fetch_query(conf, logger, sleep=stop.wait)
+
+        if query and query["result"] != 0:
+            tasks.put(query)
+
+    tasks.put(STOP)
+
+
+def model_stage(
+    conf: OmegaConf, logger: Logger, tasks: queue.Queue, results: queue.Queue
+) -> None:
+    while True:
+        WORKER_STATE.set("idle")
+        query = tasks.get()
+        if query is STOP:
+            break
+
+        WORKER_STATE.set("busy")
+        output_query = compute_result(query, conf, logger, on_item=results.put)
+        if output_query is not None:
+            results.put(output_query)
+
+    results.put(STOP)
+
+
+def upload_stage(conf: OmegaConf, logger: Logger, results: queue.Queue) -> None:
+    while True:
+        output_query = results.get()
+        if output_query is STOP:
+            break
+
+        upload_result(output_query, conf, logger)
+
+
+def run_pipeline(conf: OmegaConf, logger: Logger) -> None:
+    stop = threading.Event()
+
+    def request_stop(signum, _frame):
+        logger.info("Got signal %s, finishing claimed tasks", signum)
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    tasks = queue.Queue(maxsize=conf.pipeline.queue_depth)
+    results = queue.Queue(maxsize=conf.pipeline.upload_queue_depth)
+
+    stages = [
+        threading.Thread(target=fetch_stage, args=(conf, logger, tasks, stop)),
+        threading.Thread(target=model_stage, args=(conf, logger, tasks, results)),
+        threading.Thread(target=upload_stage, args=(conf, logger, results)),
+    ]
+
+    for stage in stages:
+        stage.start()
+
+    # join with a timeout, so the main thread keeps handling signals
+    for stage in stages:
+        while stage.is_alive():
+            stage.join(timeout=1)
+
+    logger.info("Worker pipeline stopped")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start_metrics_server(conf: OmegaConf) -> None:
+    server = ThreadingHTTPServer((conf.host, conf.port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
 def main() -> None:
     conf = OmegaConf.load("worker_config.yaml")
     logger = get_logger(__name__)
 
+    if conf.metrics.enabled:
+        start_metrics_server(conf.metrics)
+
+    if conf.previews.enabled:
+        session = get_session("coordinator", conf.coordinator_access)
+        PreviewRelay(conf, session, logger).start()
+
+    if conf.pipeline.enabled:
+        run_pipeline(conf, logger)
+        return
+
     while True:
         worker_step(conf, logger)
 